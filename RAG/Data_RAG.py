@@ -3,15 +3,85 @@ import gradio as gr
 import chromadb
 from chromadb.config import Settings
 from datetime import datetime
-import shutil
+import hashlib
 from typing import Dict, List, Optional
-from langchain.embeddings import OpenAIEmbeddings
 import json
+import re
+import threading
+import time
+
+import db_backup
+
+# Same model as the chat app, so vectors here are comparable with its SQLite stores
+DEFAULT_EMBEDDING_MODEL = "/path/sentence_transformers/all-MiniLM-L6-v2"
+
+class SentenceTransformerEmbeddings:
+    """Local sentence-transformers embeddings with the embed_query/embed_documents interface"""
+    def __init__(self, model_path: str = DEFAULT_EMBEDDING_MODEL, batch_size: int = 64):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_path)
+        self.model_name = os.path.basename(os.path.normpath(model_path))
+        self.batch_size = batch_size
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in batches, normalized so distances match cosine similarity"""
+        vectors = self.model.encode(texts, batch_size=self.batch_size,
+                                    convert_to_numpy=True, normalize_embeddings=True)
+        return vectors.tolist()
+    
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+def get_embeddings(backend: str = "local", **kwargs):
+    """Create an embedding backend: "local" (sentence-transformers) or "openai" """
+    if backend == "local":
+        return SentenceTransformerEmbeddings(**kwargs)
+    if backend == "openai":
+        from langchain.embeddings import OpenAIEmbeddings
+        return OpenAIEmbeddings(**kwargs)
+    raise ValueError(f"Unknown embedding backend: {backend}")
+
+def embedding_model_name(embeddings) -> str:
+    """Name of the model behind an embedding backend, e.g. all-MiniLM-L6-v2 or text-embedding-ada-002"""
+    return (getattr(embeddings, "model_name", None) or getattr(embeddings, "model", None)
+            or type(embeddings).__name__)
+
+# Collections written before each embedding model got its own collection are named just this
+COLLECTION_PREFIX = "exam_info"
+
+def collection_name(model_name: str) -> str:
+    """Vectors of different models differ in size and meaning, so each model gets its own collection"""
+    slug = re.sub(r"[^A-Za-z0-9_-]+", "-", model_name).strip("-_")
+    return f"{COLLECTION_PREFIX}_{slug}"[:63].rstrip("-_")
+
+EXAM_FIELDS = ["subject", "exam_time", "classroom", "teacher", "notes"]
+
+def exam_doc_id(record: Dict) -> str:
+    """Content-addressed ID: the same exam entered twice maps to the same document"""
+    normalized = [" ".join(str(record.get(field) or "").split()).casefold() for field in EXAM_FIELDS]
+    return "exam_" + hashlib.sha256("\x1f".join(normalized).encode("utf-8")).hexdigest()[:32]
+
+def directory_size(path: str) -> int:
+    """Total size in bytes of the files below path"""
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, _, filenames in os.walk(path)
+               for filename in filenames)
+
+def record_bytes(document: str, embedding: List[float], metadata: Dict) -> int:
+    """Approximate storage of one record: text, float32 vector and metadata, before index overhead"""
+    return (len(document.encode("utf-8")) + 4 * len(embedding)
+            + len(json.dumps(metadata, ensure_ascii=False).encode("utf-8")))
 
 class ExamVectorDB:
-    def __init__(self, persist_directory: str = "/ChEDdu_gpt/code/exam_vector_db"):
-        """Initialize vector database"""
+    def __init__(self, persist_directory: str = "/ChEDdu_gpt/code/exam_vector_db", embeddings=None,
+                 stats_ttl: float = 30.0):
+        """Initialize vector database
+        
+        embeddings: any object with embed_query/embed_documents, defaults to the local model
+        stats_ttl: seconds the directory size and record count are trusted before re-measuring
+        """
         self.persist_directory = os.path.abspath(persist_directory)
+        self.stats_ttl = stats_ttl
         
         # Initialize ChromaDB client
         self.client = chromadb.Client(Settings(
@@ -19,48 +89,194 @@ class ExamVectorDB:
             anonymized_telemetry=False
         ))
         
-        # Get or create collection
-        try:
-            self.collection = self.client.get_collection("exam_info")
-        except:
-            self.collection = self.client.create_collection("exam_info")
+        # Initialize embeddings, then the collection holding this model's vectors
+        self.embeddings = embeddings if embeddings is not None else get_embeddings("local")
+        self.embedding_model = embedding_model_name(self.embeddings)
+        self.collection = self._open_collection(self.embedding_model)
         
-        # Initialize OpenAI embeddings
-        self.embeddings = OpenAIEmbeddings()
+        # Kept up to date by the write paths (the size as an estimate); a filesystem walk reconciles them
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "record_count": self.collection.count(),
+            "bytes": None,
+            "last_write": (datetime.fromtimestamp(os.path.getmtime(self.persist_directory))
+                           if os.path.exists(self.persist_directory) else None),
+            "embedded_texts": 0,
+            "embedding_seconds": 0.0,
+            "last_embedding_ms": None,
+        }
+        self._measured_at = None
+    
+    def _open_collection(self, model_name: str, page_size: int = 256):
+        """The collection of model_name, created on first use and filled with the records of
+        the collections other models wrote, re-embedded with this model"""
+        name = collection_name(model_name)
+        existing = [getattr(c, "name", c) for c in self.client.list_collections()]
+        if name in existing:
+            collection = self.client.get_collection(name)
+            stored = (collection.metadata or {}).get("embedding_model")
+            if stored != model_name:
+                raise ValueError(f"Collection {name} holds vectors of {stored or 'an unknown model'}, "
+                                 f"not {model_name}; use another persist_directory or embedding model")
+            return collection
+        
+        collection = self.client.create_collection(name, metadata={"embedding_model": model_name})
+        for source_name in existing:
+            if source_name != COLLECTION_PREFIX and not source_name.startswith(COLLECTION_PREFIX + "_"):
+                continue
+            # The documents are stored with their vectors, so they can be embedded again
+            source = self.client.get_collection(source_name)
+            offset = 0
+            while True:
+                page = source.get(limit=page_size, offset=offset, include=["documents", "metadatas"])
+                if not page["ids"]:
+                    break
+                collection.upsert(ids=page["ids"], documents=page["documents"], metadatas=page["metadatas"],
+                                  embeddings=self.embeddings.embed_documents(page["documents"]))
+                offset += len(page["ids"])
+            print(f"Re-embedded {offset} records of collection {source_name} with {model_name} "
+                  f"into {name}; {source_name} is left as it was")
+        return collection
+    
+    def _embed(self, texts: List[str], query: bool = False):
+        """Embed texts and record how long the backend took"""
+        start = time.perf_counter()
+        vectors = self.embeddings.embed_query(texts[0]) if query else self.embeddings.embed_documents(texts)
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self._stats["embedded_texts"] += len(texts)
+            self._stats["embedding_seconds"] += elapsed
+            self._stats["last_embedding_ms"] = elapsed * 1000
+        return vectors
+    
+    def _record_write(self, added: int = 0, removed: int = 0, written_bytes: int = 0):
+        """Update the statistics after a write; the size grows by an estimate until refresh_stats() measures it"""
+        with self._stats_lock:
+            self._stats["record_count"] += added - removed
+            if self._stats["bytes"] is not None:
+                self._stats["bytes"] += written_bytes
+            self._stats["last_write"] = datetime.now()
+    
+    def refresh_stats(self):
+        """Re-measure the directory size and record count, replacing the running estimates"""
+        size = directory_size(self.persist_directory)
+        count = self.collection.count()
+        with self._stats_lock:
+            self._stats["bytes"] = size
+            self._stats["record_count"] = count
+            self._measured_at = time.monotonic()
+    
+    def get_stats(self, refresh: bool = True) -> Dict:
+        """Record count, size in bytes, last write time and embedding latency
+        
+        With refresh=True the size is re-measured once the TTL has expired; with
+        refresh=False only a never-measured size is computed, so writers stay cheap.
+        """
+        with self._stats_lock:
+            measured_at = self._measured_at
+        if measured_at is None or (refresh and time.monotonic() - measured_at > self.stats_ttl):
+            self.refresh_stats()
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats["stats_age_seconds"] = time.monotonic() - self._measured_at
+        embedded = stats["embedded_texts"]
+        stats["mean_embedding_ms"] = stats["embedding_seconds"] * 1000 / embedded if embedded else None
+        stats["persist_directory"] = self.persist_directory
+        return stats
     
     def add_exam_info(self, subject: str, exam_time: str, classroom: str, 
                      teacher: str, notes: str = "") -> str:
         """Add exam information to vector database"""
-        # Combine information
-        exam_info = (f"Subject: {subject}\nExam Time: {exam_time}\nClassroom: {classroom}\n"
-                    f"Teacher: {teacher}\nNotes: {notes}")
+        return self.add_many([{
+            "subject": subject,
+            "exam_time": exam_time,
+            "classroom": classroom,
+            "teacher": teacher,
+            "notes": notes
+        }])[0]
+    
+    def add_many(self, records: List[Dict], batch_size: int = 256) -> List[str]:
+        """Upsert many exam records, embedding and writing them one batch at a time
+        
+        Records already in the collection are skipped, so re-running an import is safe.
+        Returns the document ID of every record, in input order.
+        """
+        doc_ids = [exam_doc_id(r) for r in records]
+        timestamp = datetime.now()
+        for start in range(0, len(records), batch_size):
+            # Collapse duplicates within the batch, then skip documents that already exist
+            batch = dict(zip(doc_ids[start:start + batch_size], records[start:start + batch_size]))
+            existing = set(self.collection.get(ids=list(batch), include=[])["ids"])
+            batch = {doc_id: r for doc_id, r in batch.items() if doc_id not in existing}
+            if not batch:
+                continue
+            
+            # Combine information
+            documents = [(f"Subject: {r['subject']}\nExam Time: {r['exam_time']}\nClassroom: {r['classroom']}\n"
+                          f"Teacher: {r['teacher']}\nNotes: {r.get('notes', '')}") for r in batch.values()]
+            
+            # Generate vector embeddings for the whole batch at once
+            embeddings = self._embed(documents)
+            
+            metadatas = [{
+                "subject": r["subject"],
+                "exam_time": r["exam_time"],
+                "classroom": r["classroom"],
+                "teacher": r["teacher"],
+                "notes": r.get("notes", ""),
+                "timestamp": timestamp.isoformat()
+            } for r in batch.values()]
+            
+            # Store in ChromaDB
+            self.collection.upsert(
+                documents=documents,
+                embeddings=embeddings,
+                ids=list(batch),
+                metadatas=metadatas
+            )
+            self._record_write(added=len(batch), written_bytes=sum(
+                record_bytes(*record) for record in zip(documents, embeddings, metadatas)))
         
-        # Generate unique ID
-        doc_id = f"exam_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        return doc_ids
+    
+    def deduplicate(self, page_size: int = 1000) -> int:
+        """Merge records with the same content under their content-addressed ID
         
-        # Generate vector embedding
-        embedding = self.embeddings.embed_query(exam_info)
+        Covers duplicates and timestamp-based IDs written before IDs were content-addressed.
+        Returns the number of documents removed.
+        """
+        groups: Dict[str, List[str]] = {}
+        offset = 0
+        while True:
+            page = self.collection.get(limit=page_size, offset=offset, include=["metadatas"])
+            if not page["ids"]:
+                break
+            for doc_id, metadata in zip(page["ids"], page["metadatas"]):
+                groups.setdefault(exam_doc_id(metadata or {}), []).append(doc_id)
+            offset += len(page["ids"])
         
-        # Store in ChromaDB
-        self.collection.add(
-            documents=[exam_info],
-            embeddings=[embedding],
-            ids=[doc_id],
-            metadatas=[{
-                "subject": subject,
-                "exam_time": exam_time,
-                "classroom": classroom,
-                "teacher": teacher,
-                "notes": notes,
-                "timestamp": datetime.now().isoformat()
-            }]
-        )
+        removed = []
+        for content_id, ids in groups.items():
+            if ids == [content_id]:
+                continue
+            if content_id not in ids:
+                # Keep the oldest copy, re-stored under its content ID with its existing embedding
+                keep = self.collection.get(ids=[ids[0]], include=["documents", "metadatas", "embeddings"])
+                self.collection.upsert(ids=[content_id], documents=keep["documents"],
+                                       metadatas=keep["metadatas"], embeddings=keep["embeddings"])
+            removed.extend(doc_id for doc_id in ids if doc_id != content_id)
         
-        return doc_id
+        for start in range(0, len(removed), page_size):
+            self.collection.delete(ids=removed[start:start + page_size])
+        if removed:
+            # Merged copies may have been re-stored under a new ID, so count from the collection
+            self._record_write()
+            self.refresh_stats()
+        return len(removed)
     
     def search_exams(self, query: str, n_results: int = 5) -> List[Dict]:
         """Search exam information"""
-        query_embedding = self.embeddings.embed_query(query)
+        query_embedding = self._embed([query], query=True)
         results = self.collection.query(
             query_embeddings=[query_embedding],
             n_results=n_results,
@@ -68,30 +284,24 @@ class ExamVectorDB:
         )
         return results
     
-    def get_db_info(self) -> dict:
+    def get_db_info(self, refresh: bool = True) -> dict:
         """Get database information"""
-        size = sum(os.path.getsize(os.path.join(dirpath, filename))
-                  for dirpath, _, filenames in os.walk(self.persist_directory)
-                  for filename in filenames) / (1024 * 1024)  # MB
+        stats = self.get_stats(refresh=refresh)
+        last_write = stats["last_write"]
+        mean_ms = stats["mean_embedding_ms"]
         
         return {
-            "Database Location": self.persist_directory,
-            "Database Size": f"{size:.2f} MB",
-            "Number of Records": self.collection.count(),
-            "Last Updated": datetime.fromtimestamp(
-                os.path.getmtime(self.persist_directory)
-            ).strftime("%Y-%m-%d %H:%M:%S")
+            "Database Location": stats["persist_directory"],
+            "Database Size": f"{stats['bytes'] / (1024 * 1024):.2f} MB",  # MB
+            "Number of Records": stats["record_count"],
+            "Last Updated": last_write.strftime("%Y-%m-%d %H:%M:%S") if last_write else "never",
+            "Mean Embedding Latency": f"{mean_ms:.1f} ms" if mean_ms is not None else "n/a",
+            "Statistics Age": f"{stats['stats_age_seconds']:.0f} s"
         }
     
-    def backup_db(self, backup_dir: str = "./exam_db_backups") -> str:
-        """Backup database"""
-        os.makedirs(backup_dir, exist_ok=True)
-        backup_path = os.path.join(
-            backup_dir,
-            f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        )
-        shutil.copytree(self.persist_directory, backup_path)
-        return backup_path
+    def backup_db(self, backup_dir: str = "./exam_db_backups", keep: int = 10) -> str:
+        """Backup database: only files changed since the last backup are copied"""
+        return db_backup.snapshot(self.persist_directory, backup_dir, keep=keep)
 
 class ExamSystem:
     def __init__(self):
@@ -107,7 +317,8 @@ class ExamSystem:
         
         try:
             doc_id = self.db.add_exam_info(subject, exam_time, classroom, teacher, notes)
-            db_info = self.db.get_db_info()
+            # Cached statistics: saving must not walk the database directory
+            db_info = self.db.get_db_info(refresh=False)
             return (f"✅ Successfully added exam information!\n"
                    f"Document ID: {doc_id}\n"
                    f"Current database status:\n"
@@ -208,8 +419,14 @@ class ExamSystem:
                     info_display = gr.Textbox(label="Database Information", lines=5)
                     backup_btn = gr.Button("Backup Database")
                     backup_result = gr.Textbox(label="Backup Result")
+                    dedup_btn = gr.Button("Remove Duplicate Records")
+                    dedup_result = gr.Textbox(label="Duplicate Removal Result")
                     
                     info_btn.click(fn=get_info, outputs=info_display)
+                    dedup_btn.click(
+                        fn=lambda: f"Removed {self.db.deduplicate()} duplicate records",
+                        outputs=dedup_result
+                    )
                     backup_btn.click(
                         fn=lambda: f"Backup saved to: {self.db.backup_db()}",
                         outputs=backup_result
@@ -222,8 +439,9 @@ class ExamSystem:
         self.interface.launch(**kwargs)
 
 def main():
-    # Set OpenAI API key (in actual use, should be read from environment variables or config file)
-    os.environ["OPENAI_API_KEY"] = "api"
+    # Only needed with get_embeddings("openai"); the default local backend works offline
+    # (in actual use, should be read from environment variables or config file)
+    os.environ.setdefault("OPENAI_API_KEY", "api")
     
     # Create and launch application
     app = ExamSystem()
@@ -0,0 +1,218 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+from datetime import datetime
+from typing import Dict, List, Optional
+
+MANIFEST = "manifest.json"
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='Incremental backups of the Chroma directory and the SQLite stores')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    backup = commands.add_parser('backup', help='take a snapshot of a directory')
+    backup.add_argument('--source', type=str, required=True, help='directory to back up, e.g. db_1')
+    backup.add_argument('--dest', type=str, required=True, help='directory holding the snapshots')
+    backup.add_argument('--keep', type=int, default=10, help='number of snapshots to retain')
+
+    restore_parser = commands.add_parser('restore', help='verify a snapshot and restore it')
+    restore_parser.add_argument('--backup', type=str, required=True, help='snapshot directory')
+    restore_parser.add_argument('--target', type=str, required=True, help='directory to restore into')
+
+    verify_parser = commands.add_parser('verify', help='check a snapshot against its manifest')
+    verify_parser.add_argument('--backup', type=str, required=True, help='snapshot directory')
+
+    list_parser = commands.add_parser('list', help='list the snapshots of a backup directory')
+    list_parser.add_argument('--dest', type=str, required=True)
+    return parser.parse_args()
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_sqlite(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def sqlite_backup(source: str, destination: str):
+    """Consistent copy of a live database through the SQLite online backup API"""
+    src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    dst = sqlite3.connect(destination)
+    try:
+        # Copy in steps so writers are only blocked for a few pages at a time
+        src.backup(dst, pages=1024)
+    finally:
+        dst.close()
+        src.close()
+
+
+def list_backups(backup_root: str) -> List[str]:
+    """Complete snapshots under backup_root, oldest first"""
+    if not os.path.isdir(backup_root):
+        return []
+    names = sorted(name for name in os.listdir(backup_root)
+                   if name.startswith("backup_") and os.path.isfile(os.path.join(backup_root, name, MANIFEST)))
+    return [os.path.join(backup_root, name) for name in names]
+
+
+def load_manifest(backup_path: str) -> Dict:
+    with open(os.path.join(backup_path, MANIFEST), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def snapshot(source_dir: str, backup_root: str, keep: Optional[int] = 10) -> str:
+    """Back up source_dir into a new snapshot under backup_root and return its path
+
+    Files unchanged since the previous snapshot (same size and mtime) are hard-linked
+    to it, so only changed files take time and disk space. SQLite databases go through
+    the online backup API, so a database being written to is still copied consistently.
+    """
+    source_dir = os.path.abspath(source_dir)
+    os.makedirs(backup_root, exist_ok=True)
+    previous = list_backups(backup_root)
+    previous_path = previous[-1] if previous else None
+    previous_files = load_manifest(previous_path)["files"] if previous_path else {}
+
+    name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+    backup_path = os.path.join(backup_root, name)
+    # Written under a temporary name: an interrupted backup is never mistaken for a snapshot
+    staging = backup_path + ".partial"
+    files = {}
+    stats = {"copied": 0, "linked": 0, "sqlite": 0}
+    for dirpath, _, filenames in os.walk(source_dir):
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(source, source_dir)
+            if filename.endswith(("-wal", "-shm", "-journal")):
+                continue  # folded into the database copy by the backup API
+            destination = os.path.join(staging, relpath)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            status = os.stat(source)
+            entry = {"size": status.st_size, "mtime_ns": status.st_mtime_ns}
+            if os.path.exists(source + "-wal"):
+                # In WAL mode commits land in the -wal file and leave the database file untouched
+                wal = os.stat(source + "-wal")
+                entry["wal"] = [wal.st_size, wal.st_mtime_ns]
+
+            old = previous_files.get(relpath)
+            if old is not None and {k: v for k, v in old.items() if k != "sha256"} == entry:
+                try:
+                    os.link(os.path.join(previous_path, relpath), destination)
+                    entry["sha256"] = old["sha256"]
+                    files[relpath] = entry
+                    stats["linked"] += 1
+                    continue
+                except OSError:
+                    pass  # no hard links on this filesystem: copy instead
+
+            if is_sqlite(source):
+                sqlite_backup(source, destination)
+                stats["sqlite"] += 1
+            else:
+                shutil.copy2(source, destination)
+                stats["copied"] += 1
+            entry["sha256"] = file_digest(destination)
+            files[relpath] = entry
+
+    os.makedirs(staging, exist_ok=True)
+    with open(os.path.join(staging, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump({"source": source_dir, "created": datetime.now().isoformat(),
+                   "stats": stats, "files": files}, f, indent=2)
+    os.rename(staging, backup_path)
+
+    if keep is not None:
+        prune(backup_root, keep)
+    return backup_path
+
+
+def prune(backup_root: str, keep: int) -> List[str]:
+    """Delete all but the newest keep snapshots; hard-linked data lives on in the kept ones"""
+    backups = list_backups(backup_root)
+    removed = backups[:max(len(backups) - keep, 0)]
+    for path in removed:
+        shutil.rmtree(path)
+    return removed
+
+
+def verify(backup_path: str) -> List[str]:
+    """Problems found in a snapshot: missing files, checksum mismatches, damaged databases"""
+    problems = []
+    for relpath, entry in load_manifest(backup_path)["files"].items():
+        path = os.path.join(backup_path, relpath)
+        if not os.path.isfile(path):
+            problems.append(f"{relpath}: missing")
+            continue
+        if file_digest(path) != entry["sha256"]:
+            problems.append(f"{relpath}: checksum mismatch")
+            continue
+        if is_sqlite(path):
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                conn.close()
+            if result != "ok":
+                problems.append(f"{relpath}: integrity check failed: {result}")
+    return problems
+
+
+def restore(backup_path: str, target_dir: str) -> str:
+    """Replace target_dir with a verified copy of the snapshot
+
+    The previous contents are kept next to it as <target>.before_restore_<time>.
+    """
+    problems = verify(backup_path)
+    if problems:
+        raise ValueError(f"Backup {backup_path} failed verification: " + "; ".join(problems))
+
+    target_dir = os.path.abspath(target_dir.rstrip(os.sep))
+    staging = target_dir + ".restoring"
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    # Copy rather than link, so writes to the restored files cannot alter the snapshot
+    shutil.copytree(backup_path, staging, ignore=shutil.ignore_patterns(MANIFEST))
+
+    previous = None
+    if os.path.exists(target_dir):
+        previous = f"{target_dir}.before_restore_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        os.rename(target_dir, previous)
+    os.rename(staging, target_dir)
+    return previous or ""
+
+
+def main(args):
+    if args.command == 'backup':
+        path = snapshot(args.source, args.dest, keep=args.keep)
+        stats = load_manifest(path)["stats"]
+        print(f"Backup saved to {path}: {stats['linked']} files linked, "
+              f"{stats['copied']} copied, {stats['sqlite']} databases backed up")
+    elif args.command == 'restore':
+        previous = restore(args.backup, args.target)
+        print(f"Restored {args.backup} to {args.target}"
+              + (f", previous contents moved to {previous}" if previous else ""))
+    elif args.command == 'verify':
+        problems = verify(args.backup)
+        print("\n".join(problems) if problems else f"{args.backup}: ok")
+        if problems:
+            raise SystemExit(1)
+    elif args.command == 'list':
+        for path in list_backups(args.dest):
+            manifest = load_manifest(path)
+            size = sum(entry["size"] for entry in manifest["files"].values()) / (1024 * 1024)
+            print(f"{path}\t{manifest['created']}\t{len(manifest['files'])} files\t{size:.2f} MB")
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    main(args)
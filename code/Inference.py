@@ -8,6 +8,7 @@ import transformers
 from peft import PeftModel
 from transformers import GenerationConfig, TextStreamer
 from llama_attn_replace import replace_llama_attn
+from prefix_cache import PrefixCache
 print("Model version:", transformers.__version__)
 print("Torch version:", torch.__version__)
 
@@ -55,12 +56,16 @@ def read_txt_file(material_txt):
     return content
 
 def build_generator(
-    model, tokenizer, temperature=0.6, top_p=0.9, max_gen_len=4096, use_cache=True
+    model, tokenizer, temperature=0.6, top_p=0.9, max_gen_len=4096, use_cache=True, prefix_cache=None
 ):
     def response(prompt):
         print("Original prompt:", prompt)
         inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
         print("Tokenized prompt:", inputs)
+        # Reuse the precomputed system prompt key/values, only the instruction is prefilled
+        past_key_values = None
+        if use_cache and prefix_cache is not None:
+            past_key_values = prefix_cache.cache_for(inputs["input_ids"][0].tolist())
         streamer = TextStreamer(tokenizer)
         print("Generation parameters:")
         print("Max new tokens:", max_gen_len)
@@ -73,6 +78,7 @@ def build_generator(
             temperature=temperature,
             top_p=top_p,
             use_cache=use_cache,
+            past_key_values=past_key_values,
             streamer=streamer,
         )
         print("Raw model output:", output)       
@@ -119,11 +125,13 @@ def main(args):
     model.eval()
     if torch.__version__ >= "2" and sys.platform != "win32":
         model = torch.compile(model)
+    prompt_no_input = PROMPT_DICT["prompt_no_input_llama2"]
+    prefix_cache = PrefixCache(model, tokenizer)
+    prefix_cache.register("prompt_no_input_llama2", prompt_no_input.split("{instruction}")[0])
     respond = build_generator(model, tokenizer, temperature=args.temperature, top_p=args.top_p,
-                              max_gen_len=args.max_gen_len, use_cache=True)
+                              max_gen_len=args.max_gen_len, use_cache=True, prefix_cache=prefix_cache)
 
     #material = read_txt_file(args.material)
-    prompt_no_input = PROMPT_DICT["prompt_no_input_llama2"]
     prompt = prompt_no_input.format_map({"instruction": args.question})
 
     output = respond(prompt=prompt)
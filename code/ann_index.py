@@ -0,0 +1,114 @@
+import hashlib
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+def matrix_fingerprint(ids: np.ndarray, matrix: np.ndarray) -> str:
+    """Hash of row ids and embeddings, used to detect a stale persisted index"""
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(ids, dtype=np.int64).tobytes())
+    # Quantized matrices hash their stored bytes rather than a dequantized copy
+    digest.update(matrix.tobytes() if hasattr(matrix, "scales") else np.ascontiguousarray(matrix).tobytes())
+    return digest.hexdigest()
+
+
+class IVFIndex:
+    """Inverted-file index: rows are bucketed by their nearest k-means centroid and
+    a query only scores the rows in its nprobe closest buckets"""
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray,
+                 nprobe: int = 32, fingerprint: str = ""):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+        self.fingerprint = fingerprint
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, nlist: Optional[int] = None, nprobe: int = 32,
+              n_iter: int = 10, sample_size: int = 50000, seed: int = 0,
+              fingerprint: str = "") -> "IVFIndex":
+        """Train centroids with spherical k-means and assign every row to a list"""
+        n_rows = len(matrix)
+        if nlist is None:
+            nlist = int(np.sqrt(n_rows))
+        nlist = max(1, min(nlist, n_rows))
+
+        rng = np.random.default_rng(seed)
+        if n_rows > sample_size:
+            sample = matrix[rng.choice(n_rows, sample_size, replace=False)]
+        else:
+            sample = matrix
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+        for _ in range(n_iter):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=nlist)
+            empty = counts == 0
+            # Re-seed empty lists with random rows so every list stays useful
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = (sums / np.maximum(norms, 1e-12)).astype(np.float32)
+
+        assignment = cls._assign(matrix, centroids)
+        order = np.argsort(assignment, kind="stable").astype(np.int64)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=offsets[1:])
+        return cls(centroids, order, offsets, nprobe=nprobe, fingerprint=fingerprint)
+
+    @staticmethod
+    def _assign(matrix: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+        assignment = np.empty(len(matrix), dtype=np.int64)
+        for start in range(0, len(matrix), chunk_size):
+            chunk = matrix[start:start + chunk_size]
+            assignment[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+        return assignment
+
+    def search(self, matrix: np.ndarray, query_vector: np.ndarray, k: int,
+               nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (row indices, scores) of the approximate top-k rows, best first"""
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        centroid_scores = self.centroids @ query_vector
+        if nprobe < self.nlist:
+            probed = np.argpartition(centroid_scores, -nprobe)[-nprobe:]
+        else:
+            probed = np.arange(self.nlist)
+
+        candidates = np.concatenate([self.order[self.offsets[i]:self.offsets[i + 1]] for i in probed])
+        if not len(candidates):
+            return candidates, np.empty(0, dtype=np.float32)
+
+        scores = matrix[candidates] @ query_vector
+        if k < len(candidates):
+            best = np.argpartition(scores, -k)[-k:]
+        else:
+            best = np.arange(len(candidates))
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return candidates[best], scores[best]
+
+    def save(self, path: str):
+        """Persist the index next to the database file"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets,
+                     fingerprint=np.array(self.fingerprint))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, fingerprint: str, nprobe: int = 32) -> Optional["IVFIndex"]:
+        """Load a persisted index, or None if it is missing or was built from other data"""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            if str(data["fingerprint"]) != fingerprint:
+                return None
+            return cls(data["centroids"], data["order"], data["offsets"],
+                       nprobe=nprobe, fingerprint=fingerprint)
@@ -0,0 +1,402 @@
+import queue
+import threading
+import time
+from typing import Iterator, List, Optional
+
+import torch
+
+from kv_cache import cache_to_tuples, concat_rows, left_pad, repeat_rows, select_rows, trim_left
+from streaming import format_metrics, recent_generation_metrics
+
+
+class GenerationRequest:
+    """One prompt waiting for, or occupying, a slot in the running batch"""
+
+    def __init__(self, prompt_ids: List[int], max_new_tokens: int, do_sample: bool,
+                 temperature: float, top_p: float, past=None, keep_cache: bool = False, top_k: int = 0):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        # (length, per-layer key/values) already computed for prompt_ids[:length], e.g. earlier turns
+        self.past = past
+        # With keep_cache the finished request holds the key/values of every token the model read,
+        # i.e. of (prompt_ids + generated)[:cache_length]
+        self.keep_cache = keep_cache
+        self.cache = None
+        self.cache_length = 0
+        # Set when the consumer went away (e.g. a closed browser tab); the row leaves the batch
+        self.cancelled = False
+
+        self.generated: List[int] = []
+        # Receives generated token ids, then None when the request is finished
+        self.tokens: "queue.Queue[Optional[int]]" = queue.Queue()
+        self.error: Optional[Exception] = None
+        self.submit_time = time.perf_counter()
+        self.first_token_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+
+    def metrics(self):
+        end_time = self.end_time or time.perf_counter()
+        metrics = {
+            "generated_tokens": len(self.generated),
+            "total_seconds": end_time - self.submit_time,
+            "time_to_first_token": None,
+            "tokens_per_second": None,
+        }
+        if self.first_token_time is not None:
+            metrics["time_to_first_token"] = self.first_token_time - self.submit_time
+            decode_seconds = end_time - self.first_token_time
+            if len(self.generated) > 1 and decode_seconds > 0:
+                metrics["tokens_per_second"] = (len(self.generated) - 1) / decode_seconds
+        return metrics
+
+
+class ContinuousBatchScheduler:
+    """Decodes concurrent prompts as one padded batch.
+
+    New requests are prefilled and merged into the running batch between decode
+    steps, and finished sequences leave it immediately, so a long answer never
+    holds back the requests queued behind it.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 8, max_wait_ms: float = 20.0,
+                 prefix_cache=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        # Optional PrefixCache: prompts starting with a cached system prompt only prefill the rest
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.device = next(model.parameters()).device
+
+        eos_token_id = model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id
+        self.eos_token_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.max_length = getattr(model.config, "max_position_embeddings", None)
+
+        self._pending: "queue.Queue[GenerationRequest]" = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+        # Running batch: one row per active request, left-padded to a common length
+        self._active: List[GenerationRequest] = []
+        self._cache = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._next_tokens: Optional[torch.Tensor] = None
+
+    def submit_tokens(self, prompt_ids: List[int], max_new_tokens: int = 2000,
+                      do_sample: Optional[bool] = None, temperature: Optional[float] = None,
+                      top_p: Optional[float] = None, top_k: Optional[int] = None, past=None,
+                      keep_cache: bool = False) -> GenerationRequest:
+        """Queue a tokenized prompt; generated ids arrive on request.tokens.
+
+        past is an optional (length, key/values) cache of the start of the prompt; it is
+        used instead of the prefix cache, and must leave at least one prompt token uncached.
+        Sampling settings that are not passed come from the model's generation_config,
+        as they would for model.generate().
+        """
+        generation_config = self.model.generation_config
+        if do_sample is None:
+            do_sample = bool(generation_config.do_sample)
+        if temperature is None:
+            temperature = getattr(generation_config, "temperature", None) or 1.0
+        if top_p is None:
+            top_p = getattr(generation_config, "top_p", None) or 1.0
+        if top_k is None:
+            top_k = getattr(generation_config, "top_k", None) or 0
+        if self.max_length is not None:
+            max_new_tokens = min(max_new_tokens, self.max_length - len(prompt_ids))
+        if past is not None and not 0 < past[0] < len(prompt_ids):
+            past = None
+        request = GenerationRequest(list(prompt_ids), max_new_tokens, do_sample, temperature, top_p,
+                                    past=past, keep_cache=keep_cache, top_k=top_k)
+        if request.max_new_tokens <= 0:
+            request.error = ValueError("Prompt does not fit in the model context window")
+            request.tokens.put(None)
+            return request
+
+        self._ensure_worker()
+        self._pending.put(request)
+        return request
+
+    def submit(self, prompt: str, **kwargs) -> Iterator[str]:
+        """Queue a prompt and yield the growing decoded answer"""
+        prompt_ids = self.tokenizer(prompt)["input_ids"]
+        yield from self.stream(self.submit_tokens(prompt_ids, **kwargs))
+
+    def stream(self, request: GenerationRequest) -> Iterator[str]:
+        """Yield the growing decoded answer of a submitted request.
+
+        Closing the generator early (Gradio does when a client disconnects) cancels the
+        request, so it stops taking a batch slot.
+        """
+        text = ""
+        try:
+            while True:
+                token = request.tokens.get()
+                if token is None:
+                    break
+                decoded = self.tokenizer.decode(request.generated, skip_special_tokens=True)
+                # Hold back incomplete multi-byte characters until the next token completes them
+                if decoded != text and not decoded.endswith("\ufffd"):
+                    text = decoded
+                    yield text
+        finally:
+            if request.end_time is None:
+                request.cancelled = True
+
+        if request.error is not None:
+            raise request.error
+        decoded = self.tokenizer.decode(request.generated, skip_special_tokens=True)
+        if decoded != text:
+            yield decoded
+
+        metrics = request.metrics()
+        recent_generation_metrics.append(metrics)
+        print(f"Generation: {format_metrics(metrics)}")
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            admitted = self._collect_pending()
+            try:
+                with torch.inference_mode():
+                    if admitted:
+                        self._prefill(admitted)
+                    if self._active:
+                        self._decode_step()
+            except Exception as e:
+                print(f"Error in batch generation: {e}")
+                for request in self._active + admitted:
+                    if request.end_time is None:
+                        self._finish(request, error=e)
+                self._active = []
+                self._cache = None
+
+    def _collect_pending(self) -> List[GenerationRequest]:
+        free_slots = self.max_batch_size - len(self._active)
+        admitted = []
+        if free_slots <= 0:
+            return admitted
+
+        if not self._active:
+            # Idle: block for the first request, then give others a short window to join it
+            admitted.append(self._pending.get())
+            deadline = time.monotonic() + self.max_wait
+            while len(admitted) < free_slots:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    admitted.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        else:
+            # Busy: take whatever is already waiting without delaying the running batch
+            while len(admitted) < free_slots:
+                try:
+                    admitted.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+
+        for request in admitted:
+            if request.cancelled:
+                self._finish(request)
+        return [request for request in admitted if not request.cancelled]
+
+    def _prefill(self, requests: List[GenerationRequest]):
+        if self.prefix_cache is None and all(request.past is None for request in requests):
+            self._prefill_group(requests, 0, None)
+            return
+
+        # Requests sharing the same cached prefix are prefilled together
+        groups = {}
+        for request in requests:
+            if request.past is not None:
+                match, request.past = request.past, None
+            elif self.prefix_cache is not None:
+                match = self.prefix_cache.match(request.prompt_ids)
+            else:
+                match = None
+            prefix_length, layers = match if match is not None else (0, None)
+            key = (id(layers), prefix_length)
+            groups.setdefault(key, (prefix_length, layers, []))[2].append(request)
+        for prefix_length, layers, group in groups.values():
+            self._prefill_group(group, prefix_length, layers)
+
+    def _prefill_group(self, requests: List[GenerationRequest], prefix_length: int, prefix_layers):
+        suffixes = [request.prompt_ids[prefix_length:] for request in requests]
+        length = max(len(suffix) for suffix in suffixes)
+        input_ids = torch.full((len(requests), length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), prefix_length + length), dtype=torch.long)
+        attention_mask[:, :prefix_length] = 1
+        for row, suffix in enumerate(suffixes):
+            input_ids[row, length - len(suffix):] = torch.tensor(suffix)
+            attention_mask[row, prefix_length + length - len(suffix):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        # Padding sits between the prefix and the suffix, so positions come from the mask
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, prefix_length:]
+
+        cache = repeat_rows(prefix_layers, len(requests)) if prefix_layers is not None else None
+        outputs = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                             past_key_values=cache, use_cache=True)
+        next_tokens = self._sample(outputs.logits[:, -1, :], requests)
+        self._merge(requests, outputs.past_key_values, attention_mask, next_tokens)
+
+    def _merge(self, requests, cache, attention_mask, next_tokens):
+        if not self._active:
+            self._cache, self._attention_mask, self._next_tokens = cache, attention_mask, next_tokens
+        else:
+            length = max(self._attention_mask.shape[1], attention_mask.shape[1])
+            self._cache = concat_rows(left_pad(self._cache, length), left_pad(cache, length))
+            self._attention_mask = torch.cat([self._pad_mask(self._attention_mask, length),
+                                              self._pad_mask(attention_mask, length)])
+            self._next_tokens = torch.cat([self._next_tokens, next_tokens])
+        first_new_row = len(self._active)
+        self._active.extend(requests)
+        self._emit(first_new_row)
+
+    @staticmethod
+    def _pad_mask(mask: torch.Tensor, length: int) -> torch.Tensor:
+        missing = length - mask.shape[1]
+        if missing <= 0:
+            return mask
+        return torch.cat([mask.new_zeros((mask.shape[0], missing)), mask], dim=1)
+
+    def _decode_step(self):
+        self._attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones((len(self._active), 1))], dim=1)
+        position_ids = self._attention_mask.sum(-1, keepdim=True) - 1
+
+        outputs = self.model(input_ids=self._next_tokens.unsqueeze(-1), attention_mask=self._attention_mask,
+                             position_ids=position_ids, past_key_values=self._cache, use_cache=True)
+        self._cache = outputs.past_key_values
+        self._next_tokens = self._sample(outputs.logits[:, -1, :], self._active)
+        self._emit()
+
+    def _emit(self, first_row: int = 0):
+        """Hand the newest token of each row from first_row on to its request and drop finished or cancelled rows"""
+        now = time.perf_counter()
+        keep = list(range(first_row))
+        for row, (request, token) in enumerate(zip(self._active, self._next_tokens.tolist())):
+            if row < first_row:
+                continue
+            if request.cancelled:
+                self._finish(request)
+                continue
+            if request.first_token_time is None:
+                request.first_token_time = now
+            finished = token in self.eos_token_ids
+            if not finished:
+                request.generated.append(token)
+                request.tokens.put(token)
+                finished = len(request.generated) >= request.max_new_tokens
+            if finished:
+                if request.keep_cache:
+                    self._keep_row_cache(request, row)
+                self._finish(request)
+            else:
+                keep.append(row)
+
+        if len(keep) == len(self._active):
+            return
+        self._active = [self._active[row] for row in keep]
+        if not keep:
+            self._cache = self._attention_mask = self._next_tokens = None
+            return
+
+        rows = torch.tensor(keep, device=self.device)
+        self._cache = select_rows(self._cache, rows)
+        self._attention_mask = self._attention_mask.index_select(0, rows)
+        self._next_tokens = self._next_tokens.index_select(0, rows)
+
+        # Columns that are padding for every remaining row can be dropped
+        leading_padding = int((self._attention_mask.sum(0) == 0).long().cumprod(0).sum())
+        if leading_padding:
+            self._cache = trim_left(self._cache, leading_padding)
+            self._attention_mask = self._attention_mask[:, leading_padding:]
+
+    def _keep_row_cache(self, request: GenerationRequest, row: int):
+        """Copy one row's key/values out of the batch, without its padding columns"""
+        columns = self._attention_mask[row].nonzero().squeeze(-1)
+        request.cache = tuple((key[row:row + 1].index_select(-2, columns),
+                               value[row:row + 1].index_select(-2, columns))
+                              for key, value in cache_to_tuples(self._cache))
+        request.cache_length = len(columns)
+
+    def _finish(self, request: GenerationRequest, error: Optional[Exception] = None):
+        request.error = error
+        request.end_time = time.perf_counter()
+        request.tokens.put(None)
+
+    @staticmethod
+    def _sample(logits: torch.Tensor, requests: List[GenerationRequest]) -> torch.Tensor:
+        tokens = torch.argmax(logits, dim=-1)
+        for row, request in enumerate(requests):
+            if not request.do_sample or request.temperature <= 0:
+                continue
+            probs = torch.softmax(logits[row].float() / request.temperature, dim=-1)
+            if 0 < request.top_k < probs.shape[-1]:
+                # Like generate(): only the top_k most likely tokens, then top_p among them
+                probs[probs < torch.topk(probs, request.top_k).values[-1]] = 0
+                probs = probs / probs.sum()
+            if request.top_p < 1.0:
+                sorted_probs, sorted_ids = torch.sort(probs, descending=True)
+                # Keep the smallest set of tokens whose cumulative probability reaches top_p
+                outside = sorted_probs.cumsum(-1) - sorted_probs > request.top_p
+                sorted_probs[outside] = 0
+                probs = torch.zeros_like(probs).scatter(0, sorted_ids, sorted_probs)
+            tokens[row] = torch.multinomial(probs, 1)[0]
+        return tokens
+
+
+if __name__ == "__main__":
+    # CPU smoke run with a tiny random Llama: batched greedy output must match model.generate
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    class IdTokenizer:
+        eos_token_id = 2
+        pad_token_id = 0
+
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=256, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512,
+                         bos_token_id=1, eos_token_id=2)
+    tiny_model = LlamaForCausalLM(config).eval()
+    scheduler = ContinuousBatchScheduler(tiny_model, IdTokenizer(), max_batch_size=4)
+
+    prompts = [torch.randint(3, 256, (int(length),)).tolist() for length in torch.randint(4, 40, (12,))]
+    new_tokens = [int(n) for n in torch.randint(8, 48, (12,))]
+
+    start = time.perf_counter()
+    requests = [scheduler.submit_tokens(prompt, max_new_tokens=n, do_sample=False)
+                for prompt, n in zip(prompts, new_tokens)]
+    for request in requests:
+        while request.tokens.get() is not None:
+            pass
+    batched_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mismatches = 0
+    for prompt, n, request in zip(prompts, new_tokens, requests):
+        output = tiny_model.generate(torch.tensor([prompt]), max_new_tokens=n, do_sample=False,
+                                     eos_token_id=2, pad_token_id=0)
+        expected = [token for token in output[0, len(prompt):].tolist() if token != 2]
+        mismatches += expected != request.generated
+    sequential_seconds = time.perf_counter() - start
+
+    print(f"{len(prompts)} requests: batched {batched_seconds:.2f} s, sequential {sequential_seconds:.2f} s, "
+          f"{mismatches} mismatching outputs")
@@ -0,0 +1,100 @@
+import argparse
+import sqlite3
+import time
+
+import numpy as np
+
+from ann_index import IVFIndex
+from vector_codec import decode_matrix
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='Compare the IVF index with the exact scorer')
+    parser.add_argument('--db', type=str, default="", help='SQLite store to read embeddings from')
+    parser.add_argument('--table', type=str, default="vector_store")
+    parser.add_argument('--column', type=str, default="embedding")
+    parser.add_argument('--synthetic_rows', type=int, default=200000, help='rows to generate when --db is not set')
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--num_queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[8, 16, 32, 64])
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def normalize(matrix):
+    return (matrix / np.linalg.norm(matrix, axis=-1, keepdims=True)).astype(np.float32)
+
+
+def load_matrix(db_path, table, column):
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(f"SELECT {column} FROM {table} WHERE {column} IS NOT NULL").fetchall()
+    finally:
+        conn.close()
+    # float32, or a QuantizedMatrix for stores migrated to float16/int8
+    return decode_matrix([row[0] for row in rows])
+
+
+def synthetic_matrix(rows, dim, rng, n_topics=500):
+    """Clustered unit vectors, closer to sentence embeddings than uniform noise"""
+    topics = normalize(rng.standard_normal((n_topics, dim)))
+    labels = rng.integers(0, n_topics, rows)
+    return normalize(topics[labels] + 0.1 * rng.standard_normal((rows, dim)))
+
+
+def exact_top_k(matrix, query_vector, k):
+    scores = matrix @ query_vector
+    best = np.argpartition(scores, -k)[-k:]
+    return best[np.argsort(-scores[best])]
+
+
+def timed(fn, queries):
+    results, latencies = [], []
+    for query_vector in queries:
+        start = time.perf_counter()
+        results.append(fn(query_vector))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.array(latencies)
+
+
+def report(name, latencies, recall=None, recall_at_1=None):
+    line = (f"{name:<14} p50 {np.percentile(latencies, 50):8.3f} ms   "
+            f"p95 {np.percentile(latencies, 95):8.3f} ms")
+    if recall is not None:
+        line += f"   recall@k {recall:.3f}   recall@1 {recall_at_1:.3f}"
+    print(line)
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    if args.db:
+        matrix = load_matrix(args.db, args.table, args.column)
+    else:
+        matrix = synthetic_matrix(args.synthetic_rows, args.dim, rng)
+    k = min(args.k, len(matrix))
+
+    # Queries are perturbed stored rows, like paraphrased student questions
+    picked = matrix[rng.choice(len(matrix), args.num_queries)]
+    queries = normalize(picked + 0.05 * rng.standard_normal(picked.shape).astype(np.float32))
+
+    start = time.perf_counter()
+    index = IVFIndex.build(matrix, nlist=args.nlist)
+    print(f"{len(matrix)} rows x {matrix.shape[1]} dims, IVF with {index.nlist} lists "
+          f"built in {time.perf_counter() - start:.2f} s")
+
+    exact, latencies = timed(lambda q: exact_top_k(matrix, q, k), queries)
+    report("exact", latencies)
+
+    for nprobe in args.nprobe:
+        approx, latencies = timed(lambda q: index.search(matrix, q, k, nprobe=nprobe)[0], queries)
+        recall = np.mean([len(np.intersect1d(a, e)) / k for a, e in zip(approx, exact)])
+        # What best_match depends on: is the top row the true best one?
+        recall_at_1 = np.mean([len(a) > 0 and a[0] == e[0] for a, e in zip(approx, exact)])
+        report(f"ivf nprobe={nprobe}", latencies, recall, recall_at_1)
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    main(args)
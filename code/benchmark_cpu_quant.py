@@ -0,0 +1,119 @@
+import argparse
+import resource
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from cpu_quant import DEFAULT_CACHE_DIR, configure_threads, load_quantized_model, parameter_bytes
+
+PROMPTS = [
+    "What is the difference between an ionic and a covalent bond?",
+    "How do I balance the equation for the combustion of propane?",
+    "Why does the boiling point increase down the group of the halogens?",
+    "Explain Le Chatelier's principle with an example.",
+    "How many moles are in 10 grams of sodium chloride?",
+]
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='Compare int8 CPU inference with the float32 path')
+    parser.add_argument('--model_path', type=str, default="/path/model/ChEdu")
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--prompts', type=str, default="", help='text file with one prompt per line')
+    parser.add_argument('--max_new_tokens', type=int, default=64)
+    parser.add_argument('--threads', type=int, nargs='+', default=[0], help='thread counts to time, 0: physical cores')
+    return parser.parse_args()
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def wrap_prompt(text):
+    return f"<s>[INST] {text} [/INST]"
+
+
+@torch.inference_mode()
+def time_generation(model, tokenizer, prompts, max_new_tokens):
+    """Greedy outputs with prefill (time to first token) and decode timings"""
+    prefill, decode, outputs = [], [], []
+    for prompt in prompts:
+        input_ids = tokenizer(prompt, return_tensors="pt", add_special_tokens=False).input_ids
+        start = time.perf_counter()
+        model(input_ids=input_ids, use_cache=True)
+        prefill.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        output = model.generate(input_ids, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens,
+                                do_sample=False, pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id)
+        elapsed = time.perf_counter() - start
+        new_tokens = output.shape[1] - input_ids.shape[1]
+        decode.append((elapsed - prefill[-1]) / max(1, new_tokens - 1))
+        outputs.append(output[0])
+    return {"prefill_ms": 1000 * sum(prefill) / len(prefill),
+            "decode_ms_per_token": 1000 * sum(decode) / len(decode),
+            "tokens_per_second": 1 / (sum(decode) / len(decode))}, outputs
+
+
+@torch.inference_mode()
+def compare_quality(reference, candidate, sequences, prompt_lengths):
+    """Teacher-forced on the float32 outputs: how often int8 picks the same next token,
+    how far its distribution drifts (KL), and the perplexity each assigns to the answers"""
+    agree, total, kl, nll_ref, nll_cand, answer_tokens = 0, 0, 0.0, 0.0, 0.0, 0
+    for sequence, prompt_length in zip(sequences, prompt_lengths):
+        input_ids = sequence[None, :]
+        ref_logp = torch.log_softmax(reference(input_ids=input_ids).logits[0, :-1].float(), dim=-1)
+        cand_logp = torch.log_softmax(candidate(input_ids=input_ids).logits[0, :-1].float(), dim=-1)
+        agree += int((ref_logp.argmax(-1) == cand_logp.argmax(-1)).sum())
+        total += ref_logp.shape[0]
+        kl += float((ref_logp.exp() * (ref_logp - cand_logp)).sum())
+
+        targets = sequence[1:][prompt_length - 1:]
+        nll_ref -= float(ref_logp[prompt_length - 1:].gather(-1, targets[:, None]).sum())
+        nll_cand -= float(cand_logp[prompt_length - 1:].gather(-1, targets[:, None]).sum())
+        answer_tokens += len(targets)
+    return {"top1_agreement": agree / total, "mean_kl": kl / total,
+            "perplexity_fp32": float(torch.exp(torch.tensor(nll_ref / max(1, answer_tokens)))),
+            "perplexity_int8": float(torch.exp(torch.tensor(nll_cand / max(1, answer_tokens))))}
+
+
+def main(args):
+    prompts = PROMPTS
+    if args.prompts:
+        with open(args.prompts, encoding='utf-8') as f:
+            prompts = [line.strip() for line in f if line.strip()]
+    prompts = [wrap_prompt(prompt) for prompt in prompts]
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    configure_threads(args.threads[0])
+
+    start = time.perf_counter()
+    fp32 = AutoModelForCausalLM.from_pretrained(args.model_path, torch_dtype=torch.float32).eval()
+    print(f"float32: loaded in {time.perf_counter() - start:.1f} s, "
+          f"weights {parameter_bytes(fp32) / 2**20:.1f} MiB, peak RSS {rss_mb():.0f} MB")
+
+    start = time.perf_counter()
+    int8 = load_quantized_model(args.model_path, args.cache_dir)
+    print(f"int8:    loaded in {time.perf_counter() - start:.1f} s, "
+          f"weights {parameter_bytes(int8) / 2**20:.1f} MiB (run again to time the cached load)")
+
+    outputs = {}
+    for threads in args.threads:
+        threads = configure_threads(threads)
+        for name, model in (("float32", fp32), ("int8", int8)):
+            timing, generated = time_generation(model, tokenizer, prompts, args.max_new_tokens)
+            outputs.setdefault(name, generated)
+            print(f"{name:<8} {threads:>3} threads: prefill {timing['prefill_ms']:8.1f} ms | "
+                  f"decode {timing['decode_ms_per_token']:7.1f} ms/token ({timing['tokens_per_second']:.1f} tok/s)")
+
+    prompt_lengths = [len(tokenizer(prompt, add_special_tokens=False).input_ids) for prompt in prompts]
+    quality = compare_quality(fp32, int8, outputs["float32"], prompt_lengths)
+    same = sum(torch.equal(a, b) for a, b in zip(outputs["float32"], outputs["int8"]))
+    print(f"Quality over {len(prompts)} prompts: next-token agreement {quality['top1_agreement']:.3f}, "
+          f"mean KL {quality['mean_kl']:.4f}, answer perplexity {quality['perplexity_fp32']:.2f} (float32) vs "
+          f"{quality['perplexity_int8']:.2f} (int8), {same}/{len(prompts)} identical greedy answers")
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    main(args)
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import os
+import time
+from typing import Sequence
+
+import torch
+import transformers
+from transformers import AutoModelForCausalLM
+
+# Bump when the conversion changes, so older cached checkpoints are rebuilt
+QUANT_FORMAT_VERSION = 1
+DEFAULT_CACHE_DIR = "./cache/cpu_int8"
+# The output projection decides every sampled token and is the most sensitive
+# layer to int8 rounding; it stays in float32 by default
+DEFAULT_SKIP_MODULES = ("lm_head",)
+
+
+def physical_cores() -> int:
+    """CPUs this process may run on, halved when they are SMT siblings.
+
+    Matmul threads sharing a core compete for the same vector units, so one
+    thread per physical core is usually the fastest setting.
+    """
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+    try:
+        with open("/sys/devices/system/cpu/cpu0/topology/thread_siblings_list") as f:
+            siblings = len([part for part in f.read().strip().replace("-", ",").split(",") if part])
+    except OSError:
+        siblings = 1
+    return max(1, available // max(1, siblings))
+
+
+def configure_threads(num_threads: int = 0) -> int:
+    """Set torch's intra-op thread count (0: one per physical core) and return it"""
+    num_threads = num_threads or physical_cores()
+    torch.set_num_threads(num_threads)
+    try:
+        # Generation is one op after another; inter-op threads only add contention
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # can only be set before the first parallel op ran
+    return num_threads
+
+
+def model_fingerprint(model_path: str) -> str:
+    """Changes whenever the config or any weight file of a local model changes"""
+    digest = hashlib.sha256()
+    if os.path.isdir(model_path):
+        for name in sorted(os.listdir(model_path)):
+            if name.endswith((".json", ".safetensors", ".bin", ".pt")):
+                stat = os.stat(os.path.join(model_path, name))
+                digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    else:
+        digest.update(model_path.encode())  # hub id: the name is all we have
+    return digest.hexdigest()
+
+
+def quantize_linear_int8(model: torch.nn.Module, skip_modules: Sequence[str] = DEFAULT_SKIP_MODULES):
+    """Dynamic int8 quantization of the Linear layers: int8 weights with per-tensor scales,
+    activations quantized on the fly. Embeddings and norms stay in float32."""
+    from torch.ao.quantization import default_dynamic_qconfig, quantize_dynamic
+
+    qconfig_spec = {
+        name: default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and name.split(".")[-1] not in skip_modules
+    }
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def cache_path(model_path: str, cache_dir: str = DEFAULT_CACHE_DIR,
+               skip_modules: Sequence[str] = DEFAULT_SKIP_MODULES) -> str:
+    key = json.dumps({
+        "model": os.path.abspath(model_path) if os.path.isdir(model_path) else model_path,
+        "fingerprint": model_fingerprint(model_path),
+        "skip": sorted(skip_modules),
+        "format": QUANT_FORMAT_VERSION,
+        # The cached module is pickled, so it is only valid for the library versions that wrote it
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "engine": torch.backends.quantized.engine,
+    }, sort_keys=True)
+    name = os.path.basename(os.path.normpath(model_path)) or "model"
+    return os.path.join(cache_dir, f"{name}-int8-{hashlib.sha256(key.encode()).hexdigest()[:16]}.pt")
+
+
+def load_quantized_model(model_path: str, cache_dir: str = DEFAULT_CACHE_DIR,
+                         skip_modules: Sequence[str] = DEFAULT_SKIP_MODULES):
+    """An int8 CPU model, converted once and loaded from cache_dir afterwards.
+
+    The conversion needs the float32 weights in memory; a cached load reads the int8
+    checkpoint directly, so it is faster and peaks at roughly a third of the memory.
+    """
+    path = cache_path(model_path, cache_dir, skip_modules)
+    if os.path.exists(path):
+        start = time.perf_counter()
+        try:
+            # Our own file, written below: a pickled module, not just tensors
+            model = torch.load(path, map_location="cpu", weights_only=False)
+            model.eval()
+            print(f"Loaded int8 model from {path} in {time.perf_counter() - start:.1f} s")
+            return model
+        except Exception as e:
+            print(f"Could not load cached int8 model {path} ({type(e).__name__}: {e}); converting again")
+
+    start = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32)
+    model.eval()
+    quantize_linear_int8(model, skip_modules)
+    print(f"Quantized {model_path} to int8 in {time.perf_counter() - start:.1f} s")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = f"{path}.partial"
+    try:
+        torch.save(model, partial)
+        os.replace(partial, path)
+        print(f"Cached int8 model at {path} ({os.path.getsize(path) / 2**20:.1f} MiB)")
+    except OSError as e:
+        print(f"Could not cache int8 model at {path}: {e}")
+        if os.path.exists(partial):
+            os.remove(partial)
+    return model
+
+
+def load_cpu_model(model_path: str, quantization: str = "int8", num_threads: int = 0,
+                   cache_dir: str = DEFAULT_CACHE_DIR):
+    """The model for CPU inference: int8 (cached) or plain float32 with quantization="none"""
+    threads = configure_threads(num_threads)
+    print(f"CPU inference with {threads} threads, {quantization} weights")
+    if quantization == "int8":
+        return load_quantized_model(model_path, cache_dir)
+    if quantization == "none":
+        return AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32).eval()
+    raise ValueError(f"Unknown CPU quantization: {quantization}")
+
+
+def parameter_bytes(model: torch.nn.Module) -> int:
+    """Weight memory of a model: float parameters plus packed int8 weights"""
+    total = sum(p.numel() * p.element_size() for p in model.parameters())
+    for module in model.modules():
+        packed = getattr(module, "_packed_params", None)
+        if packed is not None and hasattr(module, "weight"):
+            weight = module.weight()
+            total += weight.numel() * weight.element_size()
+            bias = module.bias()
+            total += 0 if bias is None else bias.numel() * bias.element_size()
+    return total
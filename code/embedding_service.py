@@ -0,0 +1,120 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """Cache key for a query; all-MiniLM-L6-v2 is uncased so case is dropped too"""
+    return " ".join(text.split()).lower()
+
+
+class EmbeddingService:
+    """LRU-cached, micro-batched front end for SentenceTransformer.encode"""
+
+    def __init__(self, model, cache_size: int = 4096, batch_window_ms: float = 5.0,
+                 max_batch_size: int = 32):
+        self.model = model
+        self.cache_size = cache_size
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+        self._stats = {"requests": 0, "hits": 0, "batches": 0, "batched_texts": 0,
+                       "largest_batch": 0, "encode_seconds": 0.0}
+
+    def encode(self, text: str) -> np.ndarray:
+        """Embed one text, served from the cache or merged into the next batch"""
+        key = normalize_text(text)
+        with self._cache_lock:
+            self._stats["requests"] += 1
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+                self._stats["hits"] += 1
+                return vector
+
+        self._ensure_worker()
+        future: Future = Future()
+        self._queue.put((key, future))
+        return future.result()
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._encode_batch(batch)
+
+    def _encode_batch(self, batch: List[Tuple[str, Future]]):
+        # Identical texts arriving in the same window are encoded once, and texts
+        # cached while they were waiting in the queue are not encoded again
+        by_text = {}
+        with self._cache_lock:
+            for key, _ in batch:
+                if key in self._cache:
+                    by_text[key] = self._cache[key]
+        texts = [key for key in dict.fromkeys(key for key, _ in batch) if key not in by_text]
+        if not texts:
+            for key, future in batch:
+                future.set_result(by_text[key])
+            return
+
+        try:
+            start = time.perf_counter()
+            vectors = np.asarray(self.model.encode(texts), dtype=np.float32)
+            elapsed = time.perf_counter() - start
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        with self._cache_lock:
+            for text, vector in zip(texts, vectors):
+                vector.flags.writeable = False
+                by_text[text] = vector
+                self._cache[text] = vector
+                self._cache.move_to_end(text)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+            self._stats["batches"] += 1
+            self._stats["batched_texts"] += len(texts)
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(texts))
+            self._stats["encode_seconds"] += elapsed
+
+        for key, future in batch:
+            future.set_result(by_text[key])
+
+    def metrics(self) -> Dict:
+        """Cache hit rate and batch size statistics"""
+        with self._cache_lock:
+            stats = dict(self._stats)
+            stats["cached_texts"] = len(self._cache)
+        stats["hit_rate"] = stats["hits"] / stats["requests"] if stats["requests"] else 0.0
+        stats["mean_batch_size"] = stats["batched_texts"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
@@ -0,0 +1,210 @@
+import bisect
+import difflib
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from sqlite_pool import DatabaseSnapshot, get_manager
+
+QUESTION_ID_PATTERN = re.compile(r"question\s*id\s*(?:is)?\s*[:#]?\s*([A-Za-z0-9][A-Za-z0-9_\-\. ]*[A-Za-z0-9])",
+                                 re.IGNORECASE)
+
+
+def parse_question_id(text: str) -> Optional[str]:
+    """Extract the ID from inputs like 'question ID is CHEM251_2023_Exam-1-b-2'"""
+    match = QUESTION_ID_PATTERN.search(text)
+    return match.group(1).strip() if match else None
+
+
+def normalize_entry(entry: str) -> str:
+    """Compare IDs without case, and with any run of separators as one '-', so
+    'chem251 2023 exam 1 b 2' still hits but 'Exam-1-12' and 'Exam-11-2' stay apart"""
+    return re.sub(r"[^0-9a-z]+", "-", entry.lower()).strip("-")
+
+
+def compact_entry(entry: str) -> str:
+    """The ID without any separators, for inputs like 'CHEM2512023Exam1b2'"""
+    return re.sub(r"[^0-9a-z]", "", entry.lower())
+
+
+def without_trailing_words(entry: str) -> List[str]:
+    """entry, then entry with its trailing words dropped one by one, for inputs like
+    'question ID is CHEM251_2023_Exam-1-b-2 please'. Only words of two or more letters
+    are dropped; ID segments like 'b' or '2' are never taken for words."""
+    forms = [entry]
+    while True:
+        match = re.fullmatch(r"(.*\S)\s+[A-Za-z]{2,}", forms[-1])
+        if match is None:
+            return forms
+        forms.append(match.group(1))
+
+
+def has_separators(entry: str) -> bool:
+    return re.search(r"[^0-9a-z]", entry.lower()) is not None
+
+
+def transpositions(key: str):
+    """key with one pair of neighbouring characters swapped, in every possible place"""
+    for i in range(len(key) - 1):
+        if key[i] != key[i + 1]:
+            yield key[:i] + key[i + 1] + key[i] + key[i + 2:]
+
+
+class EntryData:
+    """The loaded IDs, normalized and sorted for exact, compact and prefix lookups"""
+
+    def __init__(self, rows: Dict[str, Dict], by_compact: Dict[str, List[str]]):
+        # normalized ID -> row
+        self.rows = rows
+        self.keys = sorted(rows)
+        # ID without separators -> normalized IDs; more than one is a collision
+        self.by_compact = by_compact
+        self.compact_keys = sorted(by_compact)
+
+
+class EntryLookup:
+    """Lookup of rows by their question ID column.
+
+    Only IDs that differ from a stored one in case or in how separators are written,
+    and IDs typed without any separators that fit a single stored ID, are answered.
+    Anything else close to a stored ID, a swap of two characters included, comes back
+    as a suggestion, never as that ID's row.
+    """
+
+    def __init__(self, db_path: str, columns: Sequence[str], key_column: str = "entry",
+                 table: str = "vector_store", required_columns: Sequence[str] = (),
+                 fuzzy_cutoff: float = 0.9, refresh_interval: float = 5.0):
+        self.db_path = db_path
+        self.columns = list(columns)
+        self.key_column = key_column
+        self.table = table
+        self.required_columns = list(required_columns)
+        # Minimum similarity for a "did you mean" suggestion
+        self.fuzzy_cutoff = fuzzy_cutoff
+        # Read again when the database changed, checked at most every refresh_interval seconds
+        self._snapshot = DatabaseSnapshot(db_path, self._read, refresh_interval)
+
+    def load(self) -> "EntryLookup":
+        """Read all IDs into hash maps and sorted key lists on first use, and
+        again when the database has changed since"""
+        self._snapshot.get()
+        return self
+
+    def reload(self) -> "EntryLookup":
+        self._snapshot.reload()
+        return self
+
+    def _read(self) -> EntryData:
+        selected = ", ".join(["id", self.key_column] + self.columns)
+        conditions = " AND ".join(f"{column} IS NOT NULL"
+                                  for column in [self.key_column] + self.required_columns)
+        rows = get_manager(self.db_path).execute(
+            f"SELECT {selected} FROM {self.table} WHERE {conditions} ORDER BY id").fetchall()
+
+        by_key, by_compact, duplicates = {}, {}, 0
+        for row in rows:
+            key = normalize_entry(row[1])
+            if not key:
+                continue
+            if key in by_key:
+                # Keep the first row for duplicated IDs, like INSERT OR IGNORE would
+                duplicates += 1
+                if by_key[key][self.key_column] != row[1]:
+                    print(f"Question IDs {by_key[key][self.key_column]!r} and {row[1]!r} only differ in "
+                          f"case or separators; answering with the first")
+                continue
+            record = {self.key_column: row[1], "id": row[0]}
+            record.update(zip(self.columns, row[2:]))
+            by_key[key] = record
+            by_compact.setdefault(compact_entry(row[1]), []).append(key)
+
+        for keys in by_compact.values():
+            if len(keys) > 1:
+                print(f"Question IDs {', '.join(repr(by_key[key][self.key_column]) for key in keys)} are the same "
+                      f"without separators; inputs without separators get a suggestion instead of an answer")
+        print(f"Loaded {len(by_key)} question IDs from {self.db_path}"
+              + (f" ({duplicates} duplicated rows ignored)" if duplicates else ""))
+        return EntryData(by_key, by_compact)
+
+    def get(self, entry: str) -> Optional[Dict]:
+        """Match ignoring case and how separators are written. An input without any
+        separators also matches the only stored ID that is the same without them."""
+        data = self._snapshot.get()
+        row = data.rows.get(normalize_entry(entry))
+        if row is not None or has_separators(entry):
+            return row
+        keys = data.by_compact.get(compact_entry(entry), [])
+        return data.rows[keys[0]] if len(keys) == 1 else None
+
+    def without_separators(self, entry: str) -> List[Dict]:
+        """Rows of the stored IDs that are the same as entry once separators are removed"""
+        data = self._snapshot.get()
+        return [data.rows[key] for key in data.by_compact.get(compact_entry(entry), [])]
+
+    def with_prefix(self, prefix: str, limit: int = 10) -> List[Dict]:
+        """Rows whose normalized ID starts with the normalized prefix"""
+        data = self._snapshot.get()
+        return [data.rows[key] for key in self._prefix_keys(data.keys, normalize_entry(prefix), limit)]
+
+    @staticmethod
+    def _prefix_keys(keys: List[str], prefix: str, limit: Optional[int] = None) -> List[str]:
+        start = bisect.bisect_left(keys, prefix)
+        end = bisect.bisect_right(keys, prefix + "\uffff")
+        if limit is not None:
+            end = min(end, start + limit)
+        return keys[start:end]
+
+    def transposed(self, entry: str) -> List[Dict]:
+        """Rows of the stored IDs one swap of neighbouring characters away"""
+        data = self._snapshot.get()
+        found = {key for variant in transpositions(compact_entry(entry))
+                 for key in data.by_compact.get(variant, [])}
+        return [data.rows[key] for key in sorted(found)]
+
+    def closest(self, entry: str, limit: int = 3, max_candidates: int = 200) -> List[Tuple[Dict, float]]:
+        """Near-misses for a mistyped ID, searched among IDs sharing its longest prefix"""
+        key = compact_entry(entry)
+        data = self._snapshot.get()
+        if not key or not data.compact_keys:
+            return []
+
+        # Shorten the prefix until some IDs share it, so only one course/exam is compared
+        candidates: List[str] = []
+        for length in range(len(key), 0, -1):
+            candidates = self._prefix_keys(data.compact_keys, key[:length], max_candidates)
+            if candidates:
+                break
+        matches = difflib.get_close_matches(key, candidates, n=limit, cutoff=self.fuzzy_cutoff)
+        return [(data.rows[normalized], difflib.SequenceMatcher(None, key, match).ratio())
+                for match in matches for normalized in data.by_compact[match]][:limit]
+
+    def lookup(self, entry: str, limit: int = 3) -> Optional[Dict]:
+        """The row of the ID, or the best "did you mean" candidate.
+
+        The result carries the match type ("exact" or "suggestion") and a similarity
+        score; suggestions also list the candidate IDs, best first, and the ID they
+        were looked up for (entry without trailing words).
+        """
+        forms = without_trailing_words(entry)
+        for form in forms:
+            row = self.get(form)
+            if row is not None:
+                return dict(row, match="exact", similarity=1.0)
+        entry = forms[-1]
+        # Any other ID is a different question, even 'Exam-11-2' for 'Exam-1-12' or
+        # 'Exam-1-a-12' for 'Exam-1-a-21', so near misses are only ever suggested
+        key = compact_entry(entry)
+        near = [(row, 1.0) for row in self.without_separators(entry)]
+        near += [(row, difflib.SequenceMatcher(None, key, compact_entry(row[self.key_column])).ratio())
+                 for row in self.transposed(entry)]
+        near += self.closest(entry, limit)
+
+        candidates, seen = [], set()
+        for row, ratio in near:
+            if row["id"] not in seen:
+                seen.add(row["id"])
+                candidates.append((row, ratio))
+        if not candidates:
+            return None
+        row, ratio = candidates[0]
+        return dict(row, match="suggestion", similarity=ratio, query=entry,
+                    candidates=[candidate[self.key_column] for candidate, _ in candidates[:limit]])
@@ -0,0 +1,251 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from sqlite_pool import enable_wal
+from vector_codec import DTYPE_CODES, encode_vector
+
+# Each store: source columns, the columns identifying a source row, the text that is
+# stored and embedded, and the table layout the launcher reads. Stores whose rows have
+# no natural key are keyed on every column: an edited row gets a new key, so the source
+# is a full snapshot and rows missing from it are pruned by default.
+STORES = {
+    "course": {
+        "db": "db_1/information_Q.db",
+        "source": "data/exam_info.csv",
+        "columns": ["Subject", "Exam_Time", "Classroom", "Teacher", "Notes"],
+        "key_columns": ["Subject", "Exam_Time", "Classroom", "Teacher", "Notes"],
+        "prune": True,
+        "text_column": "formatted_text",
+        "text": "The class is {Subject}, the exam time is {Exam_Time}, the Classroom is {Classroom}, "
+                "the teacher is {Teacher}, the notes is {Notes}",
+        "vector_column": "embedding",
+    },
+    "exam": {
+        "db": "db_1/vector_store_1.db",
+        "source": "data/exam_entry_answer.csv",
+        "columns": ["entry", "answer"],
+        "key_columns": ["entry"],
+        "text_column": "question",
+        "text": "The question id is {entry}",
+        "vector_column": "question_embedding",
+    },
+    "exam_entry": {
+        "db": "db_1/vector_store.db",
+        "source": "data/exam_entry_answer.csv",
+        "columns": ["entry", "answer"],
+        "key_columns": ["entry"],
+        "text_column": "formatted_text",
+        "text": "The question id is {entry}, the answer is {answer}",
+        "vector_column": "embedding",
+    },
+}
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='Build or update a SQLite vector store from CSV/XLSX')
+    parser.add_argument('--store', type=str, required=True, choices=sorted(STORES))
+    parser.add_argument('--source', type=str, default="", help='CSV or XLSX file, defaults to the store source')
+    parser.add_argument('--db', type=str, default="", help='SQLite file, defaults to the store database')
+    parser.add_argument('--model', type=str, default="/path/sentence_transformers/all-MiniLM-L6-v2")
+    parser.add_argument('--batch_size', type=int, default=256, help='rows read and embedded per batch')
+    parser.add_argument('--encoding', type=str, default="", help='CSV encoding, detected when empty')
+    parser.add_argument('--prune', dest='prune', action='store_true', default=None,
+                        help='delete rows that are no longer in the source (default for the course store)')
+    parser.add_argument('--keep_missing', dest='prune', action='store_false',
+                        help='keep rows that are no longer in the source')
+    parser.add_argument('--vector_dtype', type=str, default="float32", choices=sorted(DTYPE_CODES),
+                        help='storage format of new embeddings, see vector_codec.py')
+    return parser.parse_args()
+
+
+def detect_encoding(path: str) -> str:
+    """UTF-8 if the whole file decodes as UTF-8, else Windows-1252 (Excel's CSV export)"""
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                line.decode('utf-8')
+            except UnicodeDecodeError:
+                return 'cp1252'
+    return 'utf-8'
+
+
+def read_source(path: str, columns: List[str], batch_size: int, encoding: str = "") -> Iterator[List[Dict]]:
+    """Yield batches of source rows as dicts of strings (None for empty cells)"""
+    def clean(value):
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return None
+        value = str(value).strip()
+        return value or None
+
+    if path.lower().endswith(('.xlsx', '.xlsm')):
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [str(cell).strip() if cell is not None else "" for cell in next(rows)]
+            batch = []
+            for values in rows:
+                record = dict(zip(header, values))
+                batch.append({column: clean(record.get(column)) for column in columns})
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+        finally:
+            workbook.close()
+        return
+
+    encoding = encoding or detect_encoding(path)
+    for chunk in pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=batch_size,
+                             encoding=encoding, usecols=columns):
+        yield [{column: clean(value) for column, value in zip(columns, values)}
+               for values in chunk[columns].itertuples(index=False, name=None)]
+
+
+def source_key(row: Dict, key_columns: List[str]) -> str:
+    return "\x1f".join(row.get(column) or "" for column in key_columns)
+
+
+def content_hash(row: Dict, text: str, model_name: str) -> str:
+    """Changes when any stored value, the embedded text or the embedding model changes"""
+    digest = hashlib.sha1()
+    for value in list(row.values()) + [text, model_name]:
+        digest.update((value or "").encode('utf-8'))
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+
+def prepare_table(conn: sqlite3.Connection, store: Dict):
+    """Create the store table, or add the bookkeeping columns to an existing one"""
+    columns = store["columns"] + [store["text_column"]]
+    column_sql = ",\n            ".join(f"{column} TEXT" for column in dict.fromkeys(columns))
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS vector_store (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            {column_sql},
+            {store["vector_column"]} BLOB
+        )""")
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(vector_store)")}
+    for column in ("source_key", "content_hash"):
+        if column not in existing:
+            conn.execute(f"ALTER TABLE vector_store ADD COLUMN {column} TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_vector_store_source_key ON vector_store(source_key)")
+
+    # Rows written before source keys existed get theirs from their own columns
+    key_sql = ", ".join(store["key_columns"])
+    legacy = conn.execute(f"SELECT id, {key_sql} FROM vector_store WHERE source_key IS NULL").fetchall()
+    if legacy:
+        conn.executemany("UPDATE vector_store SET source_key = ? WHERE id = ?", [
+            ("\x1f".join("" if value is None else str(value) for value in row[1:]), row[0])
+            for row in legacy
+        ])
+
+
+def ingest(store_name: str, source: str = "", db_path: str = "", model_path: str = "",
+           batch_size: int = 256, encoding: str = "", prune: Optional[bool] = None, model=None,
+           vector_dtype: str = "float32") -> Dict:
+    """Upsert the source rows into the store, embedding only new or changed rows.
+
+    prune=None uses the store's default, see STORES.
+    """
+    store = STORES[store_name]
+    if prune is None:
+        prune = store.get("prune", False)
+    source = source or store["source"]
+    db_path = db_path or store["db"]
+    stats = {"read": 0, "unchanged": 0, "inserted": 0, "updated": 0, "deleted": 0}
+    start = time.perf_counter()
+
+    conn = sqlite3.connect(db_path)
+    try:
+        # WAL: the launcher keeps reading the old rows while the import is written
+        enable_wal(conn)
+        # One transaction for the whole import: readers see the old or the new store, never a mix
+        with conn:
+            prepare_table(conn, store)
+            existing: Dict[str, tuple] = {}
+            all_ids = set()
+            for row_id, key, digest in conn.execute(
+                    "SELECT id, source_key, content_hash FROM vector_store ORDER BY id"):
+                # Duplicated keys from older imports: keep the first row, prune the others
+                existing.setdefault(key, (row_id, digest))
+                all_ids.add(row_id)
+            seen = set()
+
+            value_columns = store["columns"] + [store["text_column"], store["vector_column"],
+                                                "source_key", "content_hash"]
+            insert_sql = (f"INSERT INTO vector_store ({', '.join(value_columns)}) "
+                          f"VALUES ({', '.join('?' for _ in value_columns)})")
+            update_sql = (f"UPDATE vector_store SET {', '.join(f'{column} = ?' for column in value_columns)} "
+                          f"WHERE id = ?")
+            model_name = os.path.basename(os.path.normpath(model_path)) if model_path else "model"
+
+            for batch in read_source(source, store["columns"], batch_size, encoding):
+                stats["read"] += len(batch)
+                pending = []
+                for row in batch:
+                    key = source_key(row, store["key_columns"])
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    text = store["text"].format(**{column: row[column] or "" for column in store["columns"]})
+                    digest = content_hash(row, text, model_name)
+                    current = existing.get(key)
+                    if current is not None and current[1] == digest:
+                        stats["unchanged"] += 1
+                        continue
+                    pending.append((row, key, text, digest, current[0] if current else None))
+
+                if not pending:
+                    continue
+                if model is None:
+                    from sentence_transformers import SentenceTransformer
+                    model = SentenceTransformer(model_path)
+                vectors = model.encode([item[2] for item in pending], batch_size=min(batch_size, 128),
+                                       convert_to_numpy=True, normalize_embeddings=True)
+                vectors = np.asarray(vectors, dtype=np.float32)
+
+                inserts, updates = [], []
+                for (row, key, text, digest, row_id), vector in zip(pending, vectors):
+                    values = [row[column] for column in store["columns"]] + [
+                        text, encode_vector(vector, vector_dtype), key, digest]
+                    if row_id is None:
+                        inserts.append(values)
+                    else:
+                        updates.append(values + [row_id])
+                conn.executemany(insert_sql, inserts)
+                conn.executemany(update_sql, updates)
+                stats["inserted"] += len(inserts)
+                stats["updated"] += len(updates)
+
+            if prune:
+                keep = {existing[key][0] for key in seen if key in existing}
+                stale = [(row_id,) for row_id in sorted(all_ids - keep)]
+                conn.executemany("DELETE FROM vector_store WHERE id = ?", stale)
+                stats["deleted"] = len(stale)
+    finally:
+        conn.close()
+
+    stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def main(args):
+    stats = ingest(args.store, source=args.source, db_path=args.db, model_path=args.model,
+                   batch_size=args.batch_size, encoding=args.encoding, prune=args.prune,
+                   vector_dtype=args.vector_dtype)
+    print(f"{args.store}: read {stats['read']} rows, inserted {stats['inserted']}, updated {stats['updated']}, "
+          f"unchanged {stats['unchanged']}, deleted {stats['deleted']} in {stats['seconds']:.2f} s")
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    main(args)
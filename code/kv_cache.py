@@ -0,0 +1,81 @@
+from typing import Tuple
+
+import torch
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # transformers < 4.36 only knows tuple caches
+    DynamicCache = None
+
+LegacyCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def cache_to_tuples(cache) -> LegacyCache:
+    """Per-layer (key, value) tensors of shape [batch, heads, seq, head_dim]"""
+    if cache is None:
+        return ()
+    if isinstance(cache, tuple):
+        return cache
+    if hasattr(cache, "layers"):
+        return tuple((layer.keys, layer.values) for layer in cache.layers)
+    if hasattr(cache, "key_cache"):
+        return tuple(zip(cache.key_cache, cache.value_cache))
+    return cache.to_legacy_cache()
+
+
+def tuples_to_cache(layers: LegacyCache):
+    """Wrap per-layer tensors in whatever cache object the installed transformers expects"""
+    if DynamicCache is None:
+        return tuple(layers)
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(tuple(layers))
+
+
+def cache_length(cache) -> int:
+    layers = cache_to_tuples(cache)
+    return layers[0][0].shape[-2] if layers else 0
+
+
+def map_cache(cache, fn):
+    """New cache with fn applied to every key and value tensor"""
+    return tuples_to_cache(tuple((fn(key), fn(value)) for key, value in cache_to_tuples(cache)))
+
+
+def copy_cache(cache):
+    """Independent copy, so generation can extend it without touching the original"""
+    return map_cache(cache, lambda tensor: tensor.clone())
+
+
+def repeat_rows(cache, count: int):
+    """Copy of a single-row cache repeated count times along the batch dimension"""
+    return map_cache(cache, lambda tensor: tensor.expand(count, *tensor.shape[1:]).clone())
+
+
+def select_rows(cache, rows: torch.Tensor):
+    return map_cache(cache, lambda tensor: tensor.index_select(0, rows))
+
+
+def left_pad(cache, length: int):
+    """Left-pad the sequence dimension with zeros up to length positions"""
+    def pad(tensor):
+        missing = length - tensor.shape[-2]
+        if missing <= 0:
+            return tensor
+        shape = list(tensor.shape)
+        shape[-2] = missing
+        return torch.cat([tensor.new_zeros(shape), tensor], dim=-2)
+    return map_cache(cache, pad)
+
+
+def trim_left(cache, start: int):
+    """Drop the first start positions of the sequence dimension"""
+    return map_cache(cache, lambda tensor: tensor[..., start:, :].contiguous())
+
+
+def concat_rows(first, second):
+    """Stack two caches of the same length along the batch dimension"""
+    return tuples_to_cache(tuple(
+        (torch.cat([key_a, key_b], dim=0), torch.cat([value_a, value_b], dim=0))
+        for (key_a, value_a), (key_b, value_b) in zip(cache_to_tuples(first), cache_to_tuples(second))
+    ))
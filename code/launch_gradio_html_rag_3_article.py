@@ -1,20 +1,30 @@
 import pandas as pd
-import sqlite3
 import re
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import gradio as gr
 import os
-import numpy as np
+import time
 from sentence_transformers import SentenceTransformer
+from vector_index import VectorIndex
+from embedding_service import EmbeddingService, normalize_text
+from entry_lookup import EntryLookup, parse_question_id
+from batch_scheduler import ContinuousBatchScheduler
+from prefix_cache import PrefixCache
+from response_cache import ResponseCache, make_key
+from startup import ComponentNotReady, Startup
+from cpu_quant import load_cpu_model
+from session_state import ConversationStore
+from streaming import generation_summary
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
 
 
 DB_PATH = r'/path/db_1/vector_store_1.db'
 COURSE_DB_PATH = r'/path/information_Q.db'
-st_model = SentenceTransformer(r'/path/sentence_transformers/all-MiniLM-L6-v2')
-import os
-print(f"Database file exists: {os.path.exists(COURSE_DB_PATH)}")
-print(f"Database file permissions: {oct(os.stat(COURSE_DB_PATH).st_mode)[-3:]}")
+EXAM_ENTRY_DB_PATH = r'/path/db_1/vector_store.db'
+SIMILARITY_THRESHOLD = 0.7
+EMBEDDING_MODEL_PATH = r'/path/sentence_transformers/all-MiniLM-L6-v2'
 
 INSTRUCTION_PREFIX = (
     "<s>[INST] <<SYS>>\n"
@@ -26,132 +36,225 @@ INSTRUCTION_PREFIX = (
     "<</SYS>> \n\n"
 )
 
+# Without CUDA the model runs with int8 linear layers ('none': float32), converted once
+# and cached in CPU_QUANT_CACHE_DIR; CPU_THREADS=0 uses one thread per physical core
+CPU_QUANTIZATION = 'int8'
+CPU_THREADS = 0
+CPU_QUANT_CACHE_DIR = r'/path/cache/cpu_int8'
+
 def load_model(model_path):
     tokenizer = AutoTokenizer.from_pretrained(model_path)
     
-    if torch.cuda.is_available():
-        device = torch.device("cuda")
-        torch_dtype = torch.float16
-    else:
-        device = torch.device("cpu")
-        torch_dtype = torch.float32
+    if not torch.cuda.is_available():
+        model = load_cpu_model(model_path, quantization=CPU_QUANTIZATION, num_threads=CPU_THREADS,
+                               cache_dir=CPU_QUANT_CACHE_DIR)
+        return model, tokenizer, torch.device("cpu")
 
+    device = torch.device("cuda")
     model = AutoModelForCausalLM.from_pretrained(
         model_path,
-        torch_dtype=torch_dtype
+        torch_dtype=torch.float16
     ).to(device)
     
     return model, tokenizer, device
 
 model_path = r'/path/model/ChEdu'  
-model, tokenizer, device = load_model(model_path)
+
+# Bump PROMPT_TEMPLATE_VERSION whenever the prompts in ask() change, so cached answers are not reused
+PROMPT_TEMPLATE_VERSION = 1
+GENERATION_PARAMS = {'max_new_tokens': 2000, 'temperature': 0.7}
+
+# Concurrent ask() calls share one decode batch of at most MAX_BATCH_SIZE prompts;
+# an idle scheduler waits MAX_WAIT_MS for more prompts before starting a batch
+MAX_BATCH_SIZE = 8
+MAX_WAIT_MS = 20
+
+# Chat turns of a browser session reuse the key/values of the earlier turns; caches are
+# evicted least recently used first above SESSION_CACHE_BYTES, and old turns are dropped
+# when a dialog leaves less than SESSION_RESERVE_TOKENS of the context window for the answer
+MAX_SESSIONS = 1000
+SESSION_CACHE_BYTES = 4 * 2**30
+SESSION_RESERVE_TOKENS = 1024
+
+def load_conversations(llm):
+    model, tokenizer, device = llm
+    context_window = getattr(model.config, 'max_position_embeddings', None) or 4096
+    return ConversationStore(tokenizer, INSTRUCTION_PREFIX, context_window, reserve_tokens=SESSION_RESERVE_TOKENS,
+                             max_sessions=MAX_SESSIONS, max_cache_bytes=SESSION_CACHE_BYTES)
+
+def load_scheduler(llm):
+    model, tokenizer, device = llm
+    # The system prompt is prefilled once; every request only prefills the text after it
+    prefix_cache = PrefixCache(model, tokenizer)
+    prefix_cache.register('instruction', INSTRUCTION_PREFIX)
+    return ContinuousBatchScheduler(model, tokenizer, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                                    prefix_cache=prefix_cache)
+
+qa_index = VectorIndex(DB_PATH, 'question_embedding', ['entry', 'question', 'answer'],
+                       required_columns=['question', 'answer'], threshold=SIMILARITY_THRESHOLD)
+course_index = VectorIndex(COURSE_DB_PATH, 'embedding',
+                           ['Subject', 'Exam_Time', 'Classroom', 'Teacher', 'Notes', 'formatted_text'],
+                           threshold=SIMILARITY_THRESHOLD)
+exam_entry_index = VectorIndex(EXAM_ENTRY_DB_PATH, 'embedding', ['entry', 'answer', 'formatted_text'],
+                               required_columns=['answer'], threshold=SIMILARITY_THRESHOLD)
+
+entry_lookup = EntryLookup(DB_PATH, ['question', 'answer'], required_columns=['question', 'answer'])
+
+# Schedule answers only depend on the matched row and the question, so they are generated once
+response_cache = ResponseCache(max_entries=256, ttl_seconds=3600)
+course_index.add_listener(lambda row_ids: response_cache.invalidate_rows('course', row_ids))
+
+# Everything heavy loads in the background, in parallel, while the server is already up;
+# routes only wait for the components they use
+startup = Startup()
+startup.add('embedder', lambda: EmbeddingService(SentenceTransformer(EMBEDDING_MODEL_PATH)))
+startup.add('llm', lambda: load_model(model_path))
+startup.add('scheduler', load_scheduler, depends=['llm'])
+startup.add('conversations', load_conversations, depends=['llm'])
+startup.add('entry_lookup', entry_lookup.load)
+startup.add('qa_index', qa_index.load)
+startup.add('course_index', course_index.load)
+startup.add('exam_entry_index', exam_entry_index.load)
+startup.start()
 
 def query_answer(text):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-
-        query_vector = st_model.encode(text)
-        
-
-        cursor.execute("SELECT entry, question, answer, question_embedding FROM vector_store")
-        results = cursor.fetchall()
-        
-
-        valid_similarities = []
-        for entry, question, answer, stored_vector in results:
-            if stored_vector is not None and question is not None and answer is not None:
-                vector = np.frombuffer(stored_vector, dtype=np.float32)
-                similarity = float(np.dot(query_vector, vector))
-                print(f"Similarity with {entry}: {similarity}")
-                valid_similarities.append([similarity, question, answer])
-        
-        if valid_similarities:
-            sorted_similarities = sorted(valid_similarities, key=lambda x: x[0], reverse=True)
-            best_match = sorted_similarities[0]
-            
-            if best_match[0] > 0.7:
+        # Question IDs are answered without calling the embedding model. An ID that is not in
+        # the table is never answered with a similar ID's answer: near misses only come back
+        # as suggestions, and text without any close ID goes to the similarity search
+        question_id = parse_question_id(text)
+        if question_id:
+            row = startup.get('entry_lookup').lookup(question_id)
+            if row is None:
+                print(f"No ID match for {question_id}, searching by similarity")
+            elif row['match'] == 'suggestion':
+                print(f"No ID match for {row['query']}, suggesting {row['candidates']}")
+                return {'question_id': row['query'], 'suggestions': row['candidates']}
+            else:
+                print(f"Exact ID match for {question_id}: {row['entry']}")
                 return {
-                    'question': best_match[1],
-                    'answer': best_match[2],
-                    'similarity': best_match[0]
+                    'question': row['question'],
+                    'answer': row['answer'],
+                    'similarity': row['similarity']
                 }
-        return None
+
+        query_vector = startup.get('embedder').encode(text)
+        best_match = startup.get('qa_index').best_match(query_vector)
+        if best_match is None:
+            return query_exam_entry(query_vector)
+
+        print(f"Best similarity with {best_match['entry']}: {best_match['similarity']}")
+        return {
+            'question': best_match['question'],
+            'answer': best_match['answer'],
+            'similarity': best_match['similarity']
+        }
         
+    except ComponentNotReady:
+        raise
     except Exception as e:
         print(f"Error in question query: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
+
+def query_exam_entry(query_vector):
+    best_match = startup.get('exam_entry_index').best_match(query_vector, columns=['entry', 'answer'])
+    if best_match is None:
+        return None
+
+    print(f"Best exam entry similarity with {best_match['entry']}: {best_match['similarity']}")
+    return {
+        'question': best_match['entry'],
+        'answer': best_match['answer'],
+        'similarity': best_match['similarity']
+    }
             
 def query_course_info(text):
-    conn = None
     try:
-        conn = sqlite3.connect(COURSE_DB_PATH)
-        cursor = conn.cursor()
-        
         subject_query = "The class is " + text.split("The Class is")[1].split(",")[0].strip()
-        query_vector = st_model.encode(subject_query)
-        
-
-        cursor.execute("""
-            SELECT Subject, Exam_Time, Classroom, Teacher, Notes, formatted_text, embedding 
-            FROM vector_store""")
-        results = cursor.fetchall()
-        
-        valid_similarities = []
-        for subject, exam_time, classroom, teacher, notes, formatted_text, stored_vector in results:
-            if stored_vector is not None:
-                vector = np.frombuffer(stored_vector, dtype=np.float32)
-                similarity = float(np.dot(query_vector, vector))
-                print(f"Similarity with {subject}: {similarity}")
-                valid_similarities.append([similarity, subject, exam_time, classroom, teacher, notes, formatted_text])
-        
-        if valid_similarities:
-            sorted_similarities = sorted(valid_similarities, key=lambda x: x[0], reverse=True)
-            best_match = sorted_similarities[0]
-            
-            if best_match[0] > 0.7:
-                return {
-                    'subject': best_match[1],
-                    'exam_time': best_match[2],
-                    'classroom': best_match[3],
-                    'teacher': best_match[4],
-                    'notes': best_match[5],
-                    'formatted_text': best_match[6],
-                    'similarity': best_match[0]
-                }
-        return None
+        query_vector = startup.get('embedder').encode(subject_query)
+        best_match = startup.get('course_index').best_match(query_vector)
+        if best_match is None:
+            return None
+
+        print(f"Best similarity with {best_match['Subject']}: {best_match['similarity']}")
+        return {
+            'subject': best_match['Subject'],
+            'exam_time': best_match['Exam_Time'],
+            'classroom': best_match['Classroom'],
+            'teacher': best_match['Teacher'],
+            'notes': best_match['Notes'],
+            'formatted_text': best_match['formatted_text'],
+            'similarity': best_match['similarity'],
+            'id': best_match['id']
+        }
               
+    except ComponentNotReady:
+        raise
     except Exception as e:
         print(f"Error in course query: {e}")
         return None
-    finally:
-        if conn:
-            conn.close()
 
-def ask(text):
+def ask(text, request: gr.Request = None):
+    try:
+        yield from answer_question(text, session_id=getattr(request, 'session_hash', None))
+    except ComponentNotReady as e:
+        if e.state == "failed":
+            yield f"This feature is unavailable: ChEdu-GPT could not load its {e.name}."
+        else:
+            yield (f"ChEdu-GPT is still starting up ({e.name} is {e.state}). "
+                   f"Exam answers by question ID work first; please try again in a minute.")
+
+def new_conversation(request: gr.Request = None):
+    session_id = getattr(request, 'session_hash', None)
+    if session_id is not None and startup.is_ready('conversations'):
+        startup.get('conversations').reset(session_id)
+    return "", ""
+
+def end_session(request: gr.Request):
+    new_conversation(request)
+
+def answer_in_session(text, session_id):
+    """Chat turn that continues the session's dialog, prefilling only the new message"""
+    conversations = startup.get('conversations')
+    scheduler = startup.get('scheduler')
+    prompt_ids, past = conversations.prompt(session_id, text)
+    request = scheduler.submit_tokens(prompt_ids, past=past, keep_cache=True, **GENERATION_PARAMS)
+    for answer in scheduler.stream(request):
+        yield answer
+    conversations.record(session_id, text, request.prompt_ids, request.generated, request.cache,
+                         request.cache_length, prefilled_tokens=len(prompt_ids) - (past[0] if past else 0))
+
+def answer_question(text, session_id=None):
     if not isinstance(text, str):
-        return "Input text must be a valid string."
+        yield "Input text must be a valid string."
+        return
 
 
+    cache_key = None
     if text.startswith("The Class is"):
         course_info = query_course_info(text)
         if course_info:
             combined_prompt = f"{INSTRUCTION_PREFIX}Based on the course information:\n" \
                             f"{course_info['formatted_text']}\n\n" \
                             f"Please provide a helpful and friendly response to: {text}[/INST]"
+            cache_key = make_key('course', course_info['id'], PROMPT_TEMPLATE_VERSION, GENERATION_PARAMS,
+                                 row_digest=startup.get('course_index').row_digest(course_info['id']),
+                                 query=normalize_text(text))
         else:
             combined_prompt = f"{INSTRUCTION_PREFIX}I apologize, but I couldn't find information for the requested course. " \
                             f"Please verify the course name and try again.[/INST]"
+            cache_key = make_key('course_missing', None, PROMPT_TEMPLATE_VERSION, GENERATION_PARAMS)
     
 
     elif text.lower().startswith("question id is"):
         print(f"\nProcessing question query: {text}")
         qa_info = query_answer(text)
         print(f"Query result: {qa_info}")
+
+        if qa_info and 'suggestions' in qa_info:
+            yield (f"I cannot find question ID {qa_info['question_id']}. Did you mean: "
+                   f"{', '.join(qa_info['suggestions'])}?")
+            return
         
         if qa_info and isinstance(qa_info, dict):
             print(f"Found match with similarity: {qa_info.get('similarity', 'N/A')}")
@@ -159,7 +262,8 @@ def ask(text):
             print(f"Answer: {qa_info.get('answer', 'N/A')}")
             
 
-            return f"Question ID: {qa_info['question']}\nAnswer: {qa_info['answer']}"
+            yield f"Question ID: {qa_info['question']}\nAnswer: {qa_info['answer']}"
+            return
             
 
             combined_prompt = f"{INSTRUCTION_PREFIX}Here is the exact answer for your question:\n\n" \
@@ -171,15 +275,25 @@ def ask(text):
                              f"Please verify the question ID and try again.[/INST]"
     
 
+    elif session_id is not None:
+        yield from answer_in_session(text, session_id)
+        return
+
     else:
         combined_prompt = f"{INSTRUCTION_PREFIX}{text}[/INST]"
 
 
-    inputs = tokenizer(combined_prompt, return_tensors='pt').to(device)
-    input_length = inputs.input_ids.shape[1]
-    outputs = model.generate(**inputs, max_new_tokens=2000, temperature=0.7, return_dict_in_generate=True)
-    tokens = outputs.sequences[0, input_length:]
-    return tokenizer.decode(tokens)
+    if cache_key is not None:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    answer = ""
+    for answer in startup.get('scheduler').submit(combined_prompt, **GENERATION_PARAMS):
+        yield answer
+    if cache_key is not None and answer:
+        response_cache.put(cache_key, answer)
 
 
 
@@ -230,10 +344,17 @@ with gr.Blocks() as server:
 
     with gr.Tab("LLM Inferencing"):
         model_input = gr.Textbox(label="Your Question:", placeholder="Enter your question here", interactive=True)
-        ask_button = gr.Button("Ask")
+        with gr.Row():
+            ask_button = gr.Button("Ask")
+            new_button = gr.Button("New conversation")
         model_output = gr.Textbox(label="The Answer:", interactive=False, placeholder="The answer will appear here...")
         
         ask_button.click(fn=ask, inputs=model_input, outputs=model_output)
+        new_button.click(fn=new_conversation, inputs=None, outputs=[model_input, model_output])
+
+    # Free the session's dialog and cache when its page is closed (gradio 4.x and later)
+    if hasattr(server, 'unload'):
+        server.unload(end_session)
     
 
     for _ in range(3):
@@ -245,4 +366,40 @@ with gr.Blocks() as server:
     with gr.Accordion("Disclaimer", open=False):
         gr.Markdown(disclaimer_text)
 
-server.launch(share=True)
\ No newline at end of file
+def healthz():
+    """Liveness: the process is up and serving, whatever is still loading"""
+    return {'status': 'ok', 'uptime_seconds': round(time.monotonic() - startup.started, 1)}
+
+def service_metrics():
+    """Generation speed, cache hit rates and session state of the components loaded so far"""
+    metrics = {'generation': generation_summary(), 'response_cache': response_cache.metrics()}
+    if startup.is_ready('embedder'):
+        metrics['embedder'] = startup.get('embedder').metrics()
+    if startup.is_ready('conversations'):
+        metrics['conversations'] = startup.get('conversations').report()
+    return metrics
+
+def readyz():
+    """Readiness: 200 once every component loaded, 503 with the startup report until then;
+    both come with the service metrics"""
+    report = startup.report()
+    ready = all(component['state'] == 'ready' for component in report.values())
+    routes = {
+        'exam_answers_by_id': startup.is_ready('entry_lookup'),
+        'exam_answers_by_similarity': startup.is_ready('embedder', 'qa_index', 'exam_entry_index'),
+        'course_schedule': startup.is_ready('embedder', 'course_index', 'scheduler'),
+        'chat': startup.is_ready('scheduler', 'conversations'),
+    }
+    return JSONResponse({'ready': ready, 'routes': routes, 'components': report, 'metrics': service_metrics()},
+                        status_code=200 if ready else 503)
+
+# Let as many requests reach the scheduler as it can batch
+try:
+    server.queue(default_concurrency_limit=MAX_BATCH_SIZE)
+except TypeError:
+    server.queue(concurrency_count=MAX_BATCH_SIZE)
+health_routes = [APIRoute('/healthz', healthz, methods=['GET']), APIRoute('/readyz', readyz, methods=['GET'])]
+try:
+    server.launch(share=True, app_kwargs={'routes': health_routes})
+except TypeError:  # gradio without app_kwargs: no health endpoints
+    server.launch(share=True)
\ No newline at end of file
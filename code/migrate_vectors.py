@@ -0,0 +1,149 @@
+import argparse
+import os
+import sqlite3
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from sqlite_pool import enable_wal
+from vector_codec import DTYPE_CODES, decode_matrix, decode_vector, encode_vector
+
+# (database, embedding column) of the stores the launcher reads
+STORES = {
+    "course": ("db_1/information_Q.db", "embedding"),
+    "exam": ("db_1/vector_store_1.db", "question_embedding"),
+    "exam_entry": ("db_1/vector_store.db", "embedding"),
+}
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='Convert stored embeddings between float32, float16 and int8')
+    parser.add_argument('--store', type=str, default="", choices=[""] + sorted(STORES))
+    parser.add_argument('--db', type=str, default="", help='SQLite file, defaults to the store database')
+    parser.add_argument('--table', type=str, default="vector_store")
+    parser.add_argument('--column', type=str, default="", help='embedding column, defaults to the store column')
+    parser.add_argument('--dtype', type=str, required=True, choices=sorted(DTYPE_CODES))
+    parser.add_argument('--queries', type=str, default="", help='text file with one exam query per line')
+    parser.add_argument('--model', type=str, default="/path/sentence_transformers/all-MiniLM-L6-v2",
+                        help='embedding model for --queries')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.7, help='similarity threshold of the launcher')
+    parser.add_argument('--report_only', action='store_true', help='measure the accuracy without writing')
+    parser.add_argument('--vacuum', action='store_true', help='VACUUM afterwards to return the freed space')
+    return parser.parse_args()
+
+
+def read_vectors(conn: sqlite3.Connection, table: str, column: str):
+    rows = conn.execute(f"SELECT id, {column} FROM {table} WHERE {column} IS NOT NULL ORDER BY id").fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+def float32_matrix(blobs: List[bytes]) -> np.ndarray:
+    """Reference matrix, dequantized from whatever format the rows are in now"""
+    rows = []
+    for blob in blobs:
+        _, values, scale = decode_vector(blob)
+        rows.append(values.astype(np.float32) * scale)
+    return np.vstack(rows)
+
+
+def accuracy_report(reference: np.ndarray, converted, queries: np.ndarray, k: int, threshold: float) -> Dict:
+    """How much ranking and the launcher's threshold decision change after conversion"""
+    k = min(k, len(reference))
+    top1, recall, flips, errors = 0, 0.0, 0, []
+    for query_vector in queries:
+        exact = reference @ query_vector
+        approx = converted @ query_vector
+        errors.append(np.abs(exact - approx).max())
+        best_exact = np.argsort(-exact)[:k]
+        best_approx = np.argsort(-approx)[:k]
+        top1 += best_exact[0] == best_approx[0]
+        recall += len(set(best_exact) & set(best_approx)) / k
+        # Would the launcher accept or reject its best match differently?
+        flips += (exact[best_exact[0]] > threshold) != (approx[best_approx[0]] > threshold)
+    n = len(queries)
+    return {"queries": n, "top1_agreement": top1 / n, f"recall@{k}": recall / n,
+            "threshold_flips": int(flips), "max_score_error": float(max(errors)),
+            "mean_max_score_error": float(np.mean(errors))}
+
+
+def load_queries(path: str, model_path: str, reference: np.ndarray, rng) -> np.ndarray:
+    """Embedded exam queries, or stored rows with noise when no query file is given"""
+    if path:
+        from sentence_transformers import SentenceTransformer
+        with open(path, encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+        model = SentenceTransformer(model_path)
+        return np.asarray(model.encode(texts, normalize_embeddings=True), dtype=np.float32)
+    queries = reference[rng.choice(len(reference), min(len(reference), 200), replace=False)]
+    queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def migrate(db_path: str, table: str, column: str, dtype: str, queries: Optional[np.ndarray] = None,
+            k: int = 5, threshold: float = 0.7, report_only: bool = False, vacuum: bool = False) -> Dict:
+    conn = sqlite3.connect(db_path)
+    try:
+        ids, blobs = read_vectors(conn, table, column)
+        if not ids:
+            return {"rows": 0}
+        reference = float32_matrix(blobs)
+        new_blobs = [encode_vector(vector, dtype) for vector in reference]
+        converted = decode_matrix(new_blobs)
+        if queries is None:
+            queries = load_queries("", "", reference, np.random.default_rng(0))
+        report = accuracy_report(reference, converted, queries, k, threshold)
+        report.update({"rows": len(ids), "dtype": dtype,
+                       "bytes_before": sum(len(blob) for blob in blobs),
+                       "bytes_after": sum(len(blob) for blob in new_blobs)})
+
+        if not report_only:
+            enable_wal(conn)
+            with conn:
+                conn.executemany(f"UPDATE {table} SET {column} = ? WHERE id = ?",
+                                 [(blob, row_id) for blob, row_id in zip(new_blobs, ids)])
+            if vacuum:
+                conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return report
+
+
+def main(args):
+    if args.store:
+        db_path, column = STORES[args.store]
+        db_path, column = args.db or db_path, args.column or column
+    elif args.db and args.column:
+        db_path, column = args.db, args.column
+    else:
+        raise SystemExit("Pass --store, or both --db and --column")
+
+    queries = None
+    if args.queries:
+        conn = sqlite3.connect(db_path)
+        try:
+            reference = float32_matrix(read_vectors(conn, args.table, column)[1])
+        finally:
+            conn.close()
+        queries = load_queries(args.queries, args.model, reference, None)
+
+    size_before = os.path.getsize(db_path)
+    report = migrate(db_path, args.table, column, args.dtype, queries, k=args.k, threshold=args.threshold,
+                     report_only=args.report_only, vacuum=args.vacuum)
+    if not report["rows"]:
+        print(f"No embeddings in {db_path}")
+        return
+    print(f"{db_path} {column}: {report['rows']} rows as {report['dtype']}, embeddings "
+          f"{report['bytes_before'] / 1024:.1f} KiB -> {report['bytes_after'] / 1024:.1f} KiB")
+    print(f"  {report['queries']} queries: top-1 agreement {report['top1_agreement']:.3f}, "
+          f"recall@{args.k} {report[f'recall@{args.k}']:.3f}, {report['threshold_flips']} threshold flips, "
+          f"max score error {report['max_score_error']:.5f} (mean {report['mean_max_score_error']:.5f})")
+    if args.report_only:
+        print("  report only, nothing written")
+    else:
+        print(f"  database file {size_before / 1024:.1f} KiB -> {os.path.getsize(db_path) / 1024:.1f} KiB")
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    main(args)
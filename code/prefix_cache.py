@@ -0,0 +1,94 @@
+import hashlib
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from kv_cache import LegacyCache, cache_to_tuples, copy_cache
+
+
+def model_fingerprint(model) -> Tuple:
+    """Identifies the loaded weights; a different model (or a reload) misses the cache"""
+    return (id(model), getattr(model.config, "_name_or_path", ""), getattr(model, "dtype", None))
+
+
+class PrefixCache:
+    """Past key/values of fixed system prompts, computed once and shared by every request.
+
+    Entries are keyed by the prefix text and the model that produced them. Requests
+    get copies, so extending a prefix for one prompt never changes the shared entry.
+    """
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self._lock = threading.Lock()
+        self._model_key = model_fingerprint(model)
+        self._texts: Dict[str, str] = {}
+        # name -> (text digest, token ids, per-layer key/value tensors)
+        self._entries: Dict[str, Tuple[str, List[int], LegacyCache]] = {}
+
+    def register(self, name: str, text: str):
+        """Prefill text once; re-registering a name with different text replaces the entry"""
+        with self._lock:
+            self._texts[name] = text
+            self._refresh()
+
+    def clear(self):
+        with self._lock:
+            self._texts.clear()
+            self._entries.clear()
+
+    def _refresh(self):
+        model_key = model_fingerprint(self.model)
+        if model_key != self._model_key:
+            self._entries.clear()
+            self._model_key = model_key
+
+        for name, text in self._texts.items():
+            digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            entry = self._entries.get(name)
+            if entry is None or entry[0] != digest:
+                self._entries[name] = (digest,) + self._prefill(text)
+                print(f"Cached {len(self._entries[name][1])} prefix tokens for '{name}'")
+
+    def _prefill(self, text: str) -> Tuple[List[int], LegacyCache]:
+        prefix_ids = self.tokenizer(text)["input_ids"]
+        device = next(self.model.parameters()).device
+        with torch.inference_mode():
+            outputs = self.model(input_ids=torch.tensor([prefix_ids], device=device), use_cache=True)
+        return prefix_ids, cache_to_tuples(outputs.past_key_values)
+
+    def match(self, prompt_ids: List[int]) -> Optional[Tuple[int, LegacyCache]]:
+        """Longest cached prefix of prompt_ids as (length, shared key/value tensors).
+
+        At least one prompt token is always left uncached, since generation needs the
+        logits of the last prompt position. Callers must copy before extending.
+        """
+        with self._lock:
+            self._refresh()
+            entries = list(self._entries.values())
+
+        best_length, best_layers = 0, None
+        for _, prefix_ids, layers in entries:
+            limit = min(len(prefix_ids), len(prompt_ids) - 1)
+            length = 0
+            # The tokenizer may merge the last prefix tokens with the request text,
+            # so only the common token run is reused
+            while length < limit and prefix_ids[length] == prompt_ids[length]:
+                length += 1
+            if length > best_length:
+                best_length, best_layers = length, layers
+        if best_layers is None:
+            return None
+        if best_length < best_layers[0][0].shape[-2]:
+            best_layers = tuple((key[..., :best_length, :], value[..., :best_length, :])
+                                for key, value in best_layers)
+        return best_length, best_layers
+
+    def cache_for(self, prompt_ids: List[int]):
+        """Private copy of the matching prefix cache, ready to pass as past_key_values"""
+        match = self.match(prompt_ids)
+        if match is None:
+            return None
+        return copy_cache(match[1])
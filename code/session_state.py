@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from kv_cache import LegacyCache
+
+
+def cache_nbytes(layers: Optional[LegacyCache]) -> int:
+    if not layers:
+        return 0
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in layers)
+
+
+class Conversation:
+    """One browser session's dialog: its turns, their tokens and the model's key/values for them"""
+
+    def __init__(self):
+        # (student message, answer token ids) of every turn still in the context window
+        self.turns: List[Tuple[str, List[int]]] = []
+        # Prompt of the kept turns as the model read it, answers included
+        self.token_ids: List[int] = []
+        # Key/values of token_ids[:cache_length]; None when evicted or invalidated
+        self.cache: Optional[LegacyCache] = None
+        self.cache_length = 0
+        self.dropped_turns = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def cache_bytes(self) -> int:
+        return cache_nbytes(self.cache)
+
+
+class ConversationStore:
+    """Multi-turn chat state keyed by session, so a new turn only prefills the new message.
+
+    Turns use the Llama-2 chat layout, which only ever appends to the prompt:
+        <s>[INST] <<SYS>>...<</SYS>> first message[/INST] answer</s><s>[INST] next message[/INST]
+    so the key/values of everything before the new message stay valid. Caches are
+    evicted least recently used first to stay under max_cache_bytes (the dialog text
+    is kept, and re-prefilled on the next turn); whole sessions beyond max_sessions are
+    dropped. When a dialog outgrows the context window its oldest turns are dropped.
+    """
+
+    def __init__(self, tokenizer, system_prompt: str, context_window: int, reserve_tokens: int = 1024,
+                 max_sessions: int = 1000, max_cache_bytes: int = 2 * 2**30):
+        self.tokenizer = tokenizer
+        self.system_prompt = system_prompt
+        self.context_window = context_window
+        # Room left for the answer when older turns have to be dropped
+        self.reserve_tokens = min(reserve_tokens, context_window // 2)
+        self.max_sessions = max_sessions
+        self.max_cache_bytes = max_cache_bytes
+        self.end_of_turn = [tokenizer.eos_token_id]
+
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._cache_bytes = 0
+        self.stats = {"turns": 0, "cached_tokens": 0, "prefilled_tokens": 0, "evicted_caches": 0,
+                      "evicted_sessions": 0, "truncated_turns": 0}
+
+    def _first_turn(self, message: str) -> List[int]:
+        # Same text and tokenization as a stateless prompt, so the PrefixCache still applies
+        return self.tokenizer(f"{self.system_prompt}{message}[/INST]")["input_ids"]
+
+    def _next_turn(self, message: str) -> List[int]:
+        turn = self.tokenizer(f"<s>[INST] {message}[/INST]", add_special_tokens=False)["input_ids"]
+        return self.end_of_turn + turn
+
+    def _render(self, turns: List[Tuple[str, List[int]]], message: str) -> List[int]:
+        """Prompt for turns followed by message, re-tokenized from scratch"""
+        messages = [text for text, _ in turns] + [message]
+        answers = [answer for _, answer in turns]
+        token_ids = self._first_turn(messages[0])
+        for answer, text in zip(answers, messages[1:]):
+            token_ids += answer + self._next_turn(text)
+        return token_ids
+
+    def prompt(self, session_id: str, message: str) -> Tuple[List[int], Optional[Tuple[int, LegacyCache]]]:
+        """Prompt ids for the session's next turn and the (length, key/values) cached for its start.
+
+        The cache is handed over to the caller: it is extended by generation and comes
+        back through record(). A turn running concurrently in the same session re-prefills.
+        """
+        with self._lock:
+            conversation = self._sessions.get(session_id)
+            if conversation is None:
+                return self._first_turn(message), None
+            self._sessions.move_to_end(session_id)
+            conversation.last_used = time.monotonic()
+            turns = list(conversation.turns)
+            if not turns:
+                token_ids = self._first_turn(message)
+            elif conversation.token_ids:
+                token_ids = conversation.token_ids + self._next_turn(message)
+            else:
+                token_ids = self._render(turns, message)
+            cache, cache_length = conversation.cache, conversation.cache_length
+            self._cache_bytes -= conversation.cache_bytes
+            conversation.cache, conversation.cache_length = None, 0
+
+        if len(token_ids) + self.reserve_tokens > self.context_window and turns:
+            # Dropping the oldest turns shifts every later position, so the cache is invalid.
+            # Drop down to half the usable window, so the next turns are cached again
+            # instead of every turn re-prefilling a full window.
+            target = (self.context_window - self.reserve_tokens) // 2
+            dropped = 0
+            while turns and len(token_ids) > target:
+                turns.pop(0)
+                dropped += 1
+                token_ids = self._render(turns, message)
+            with self._lock:
+                conversation.turns = conversation.turns[dropped:]
+                # Rebuilt by the next record(), which also accepts the re-tokenized prompt
+                conversation.token_ids = []
+                conversation.dropped_turns += dropped
+                self.stats["truncated_turns"] += dropped
+            print(f"Session {session_id[:8]}: dropped {dropped} old turns to fit the context window")
+            return token_ids, None
+
+        if cache is None or cache_length >= len(token_ids):
+            return token_ids, None
+        return token_ids, (cache_length, cache)
+
+    def record(self, session_id: str, message: str, prompt_ids: List[int], answer_ids: List[int],
+               cache: Optional[LegacyCache] = None, cache_length: int = 0, prefilled_tokens: int = 0):
+        """Store a finished turn; cache holds the key/values of (prompt_ids + answer_ids)[:cache_length]"""
+        with self._lock:
+            conversation = self._sessions.get(session_id)
+            if conversation is None:
+                conversation = self._sessions[session_id] = Conversation()
+            self._sessions.move_to_end(session_id)
+            self._cache_bytes -= conversation.cache_bytes
+
+            if not conversation.turns or prompt_ids[:len(conversation.token_ids)] == conversation.token_ids:
+                conversation.turns.append((message, list(answer_ids)))
+                conversation.token_ids = list(prompt_ids) + list(answer_ids)
+                conversation.cache, conversation.cache_length = cache, cache_length
+            else:
+                # Another turn of this session finished first: keep the text, re-prefill next time
+                conversation.turns.append((message, list(answer_ids)))
+                conversation.token_ids = self._render(conversation.turns[:-1], message) + list(answer_ids)
+                conversation.cache, conversation.cache_length = None, 0
+            conversation.last_used = time.monotonic()
+            self._cache_bytes += conversation.cache_bytes
+
+            self.stats["turns"] += 1
+            self.stats["cached_tokens"] += len(prompt_ids) - prefilled_tokens
+            self.stats["prefilled_tokens"] += prefilled_tokens
+            self._evict()
+
+    def _evict(self):
+        while len(self._sessions) > self.max_sessions:
+            _, conversation = self._sessions.popitem(last=False)
+            self._cache_bytes -= conversation.cache_bytes
+            self.stats["evicted_sessions"] += 1
+        if self._cache_bytes <= self.max_cache_bytes:
+            return
+        # Least recently used first; the newest session keeps its cache even if it is over budget alone
+        for conversation in list(self._sessions.values())[:-1]:
+            if self._cache_bytes <= self.max_cache_bytes:
+                break
+            if conversation.cache is not None:
+                self._cache_bytes -= conversation.cache_bytes
+                conversation.cache, conversation.cache_length = None, 0
+                self.stats["evicted_caches"] += 1
+
+    def reset(self, session_id: str):
+        """Forget a session, e.g. for a new conversation or when its page is closed"""
+        with self._lock:
+            conversation = self._sessions.pop(session_id, None)
+            if conversation is not None:
+                self._cache_bytes -= conversation.cache_bytes
+
+    def turn_count(self, session_id: str) -> int:
+        with self._lock:
+            conversation = self._sessions.get(session_id)
+            return len(conversation.turns) if conversation is not None else 0
+
+    def report(self) -> Dict:
+        with self._lock:
+            return dict(self.stats, sessions=len(self._sessions), cache_bytes=self._cache_bytes,
+                        cached_sessions=sum(c.cache is not None for c in self._sessions.values()))
@@ -0,0 +1,170 @@
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Generic, List, Optional, Tuple, TypeVar
+
+
+def enable_wal(conn: sqlite3.Connection) -> str:
+    """Switch a writable connection's database to WAL, so writers never block readers.
+
+    The journal mode is stored in the database file; every later connection uses it.
+    Writers (ingest.py, migrate_vectors.py) call this; readers never change the file.
+    """
+    mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    # Durable at every checkpoint, without an fsync on every commit
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return mode
+
+
+class ConnectionManager:
+    """Persistent read-only connections to one SQLite database, one per thread.
+
+    Each connection keeps its page cache and prepared statements between requests.
+    The database file is re-opened when it is replaced (e.g. by a restore), and
+    version() tells whether anyone committed since the last call.
+    """
+
+    def __init__(self, db_path: str, mmap_size: int = 256 * 2**20, cache_size_kb: int = 64 * 1024,
+                 cached_statements: int = 256):
+        self.db_path = os.path.abspath(db_path)
+        self.mmap_size = mmap_size
+        self.cache_size_kb = cache_size_kb
+        self.cached_statements = cached_statements
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._watch: Optional[Tuple[Tuple[int, int], sqlite3.Connection]] = None
+
+    def _identity(self) -> Tuple[int, int]:
+        stat = os.stat(self.db_path)
+        return stat.st_dev, stat.st_ino
+
+    def _open(self) -> sqlite3.Connection:
+        uri = pathlib.Path(self.db_path).as_uri() + "?mode=ro"
+        # check_same_thread=False only so close() can run from another thread;
+        # each connection is still used by the thread that opened it
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute(f"PRAGMA cache_size={-int(self.cache_size_kb)}")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """This thread's connection, opened on first use"""
+        identity = self._identity()
+        cached = getattr(self._local, "conn", None)
+        # A connection closed by close() is not in the list any more and is replaced
+        if cached is not None and cached[0] == identity and cached[1] in self._connections:
+            return cached[1]
+        if cached is not None:
+            self._discard(cached[1])
+        conn = self._open()
+        self._local.conn = (identity, conn)
+        return conn
+
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        """Run a query on this thread's connection; the statement stays prepared for the next call"""
+        return self.connection().execute(sql, parameters)
+
+    def version(self) -> Tuple:
+        """Changes whenever the database is committed to by another connection or replaced"""
+        identity = self._identity()
+        with self._lock:
+            if self._watch is None or self._watch[0] != identity:
+                if self._watch is not None:
+                    self._watch[1].close()
+                uri = pathlib.Path(self.db_path).as_uri() + "?mode=ro"
+                self._watch = (identity, sqlite3.connect(uri, uri=True, check_same_thread=False))
+            return identity, self._watch[1].execute("PRAGMA data_version").fetchone()[0]
+
+    def _discard(self, conn: sqlite3.Connection):
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+            if self._watch is not None:
+                connections.append(self._watch[1])
+                self._watch = None
+        for conn in connections:
+            conn.close()
+
+
+_managers: Dict[str, ConnectionManager] = {}
+_managers_lock = threading.Lock()
+
+
+def get_manager(db_path: str) -> ConnectionManager:
+    """The shared connection manager of a database file"""
+    key = os.path.abspath(db_path)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = _managers[key] = ConnectionManager(key)
+        return manager
+
+
+T = TypeVar("T")
+
+
+class DatabaseSnapshot(Generic[T]):
+    """A value built from a database with read(), built again when the database changes.
+
+    get() asks version() at most every refresh_interval seconds. The new value is
+    built aside and swapped in, so readers always see one complete snapshot.
+    on_reload(previous, current) is called after each reload that replaced a value.
+    """
+
+    def __init__(self, db_path: str, read: Callable[[], T], refresh_interval: float = 5.0,
+                 on_reload: Optional[Callable[[T, T], None]] = None):
+        self.db_path = db_path
+        self.read = read
+        self.refresh_interval = refresh_interval
+        self.on_reload = on_reload
+
+        self._lock = threading.Lock()
+        self._value: Optional[T] = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def get(self) -> T:
+        """The current value, read on first use and again when the database has changed since"""
+        if self._value is not None and time.monotonic() - self._checked_at < self.refresh_interval:
+            return self._value
+        with self._lock:
+            if self._value is None:
+                self._reload()
+            elif time.monotonic() - self._checked_at >= self.refresh_interval:
+                self._checked_at = time.monotonic()
+                if self._stamp() != self._version:
+                    self._reload()
+            return self._value
+
+    def reload(self) -> T:
+        """Read the database again, whether it changed or not"""
+        with self._lock:
+            self._reload()
+            return self._value
+
+    def _stamp(self):
+        # PRAGMA data_version plus the file identity: catches commits and replaced files
+        try:
+            return get_manager(self.db_path).version()
+        except (OSError, sqlite3.Error):
+            return None
+
+    def _reload(self):
+        version = self._stamp()
+        previous, self._value = self._value, self.read()
+        self._version = version
+        self._checked_at = time.monotonic()
+        if previous is not None and self.on_reload is not None:
+            self.on_reload(previous, self._value)
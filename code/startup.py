@@ -0,0 +1,112 @@
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, Optional, Sequence
+
+
+class ComponentNotReady(RuntimeError):
+    """Raised when a request needs a component that is still loading or failed to load"""
+
+    def __init__(self, name: str, state: str):
+        super().__init__(f"{name} is {state}")
+        self.name = name
+        self.state = state
+
+
+class Component:
+    def __init__(self, name: str, loader: Callable, depends: Sequence[str]):
+        self.name = name
+        self.loader = loader
+        self.depends = list(depends)
+        self.future: Future = Future()
+        self.state = "pending"
+        self.started: Optional[float] = None
+        self.seconds: Optional[float] = None
+        self.error: Optional[str] = None
+
+
+class Startup:
+    """Loads the app's heavy components in background threads, in parallel where possible.
+
+    Components are registered with add() and start loading once their dependencies
+    are ready. Request handlers call get() and fail fast while a component loads.
+    """
+
+    def __init__(self, max_workers: int = 8):
+        self._components: Dict[str, Component] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="startup")
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def add(self, name: str, loader: Callable, depends: Sequence[str] = ()):
+        """loader(*dependency values) returns the component"""
+        self._components[name] = Component(name, loader, depends)
+
+    def start(self) -> "Startup":
+        for component in self._components.values():
+            self._executor.submit(self._load, component)
+        return self
+
+    def _load(self, component: Component):
+        try:
+            values = [self._components[name].future.result() for name in component.depends]
+        except Exception as e:
+            self._finish(component, error=f"dependency failed: {e}")
+            return
+        with self._lock:
+            component.state = "loading"
+            component.started = time.monotonic()
+        try:
+            value = component.loader(*values)
+        except Exception as e:
+            traceback.print_exc()
+            self._finish(component, error=f"{type(e).__name__}: {e}")
+            return
+        self._finish(component, value=value)
+
+    def _finish(self, component: Component, value=None, error: Optional[str] = None):
+        with self._lock:
+            now = time.monotonic()
+            component.seconds = now - (component.started or now)
+            component.state = "failed" if error else "ready"
+            component.error = error
+        if error:
+            component.future.set_exception(ComponentNotReady(component.name, "failed"))
+            print(f"Startup: {component.name} failed after {component.seconds:.1f} s: {error}")
+        else:
+            component.future.set_result(value)
+            print(f"Startup: {component.name} ready in {component.seconds:.1f} s "
+                  f"({now - self.started:.1f} s after start)")
+        with self._lock:
+            done = all(c.state in ("ready", "failed") for c in self._components.values())
+        if done:
+            print(f"Startup report ({time.monotonic() - self.started:.1f} s in total):")
+            for name, entry in self.report().items():
+                print(f"  {name:<20} {entry['state']:<8} {entry['seconds']:8.2f} s"
+                      + (f"  {entry['error']}" if entry['error'] else ""))
+
+    def get(self, name: str, timeout: Optional[float] = 0):
+        """The loaded component; waits up to timeout seconds (None: forever) before raising ComponentNotReady"""
+        component = self._components[name]
+        try:
+            return component.future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise ComponentNotReady(name, component.state) from None
+
+    def is_ready(self, *names: str) -> bool:
+        return all(self._components[name].state == "ready" for name in names)
+
+    def report(self) -> Dict[str, Dict]:
+        """Per-component state and load time, for the readiness endpoint and the logs"""
+        with self._lock:
+            now = time.monotonic()
+            return {
+                name: {
+                    "state": component.state,
+                    "seconds": round(component.seconds if component.seconds is not None else
+                                     (now - component.started if component.started else 0.0), 3),
+                    "error": component.error,
+                }
+                for name, component in self._components.items()
+            }
@@ -0,0 +1,29 @@
+from collections import deque
+from typing import Dict, Optional
+
+# Metrics of the most recent generations, newest last
+recent_generation_metrics = deque(maxlen=100)
+
+
+def format_metrics(metrics: Dict) -> str:
+    parts = [f"{metrics['generated_tokens']} tokens in {metrics['total_seconds']:.2f} s"]
+    if metrics["time_to_first_token"] is not None:
+        parts.append(f"time to first token {metrics['time_to_first_token']:.2f} s")
+    if metrics["tokens_per_second"] is not None:
+        parts.append(f"{metrics['tokens_per_second']:.1f} tokens/s")
+    return ", ".join(parts)
+
+
+def generation_summary() -> Dict[str, Optional[float]]:
+    """Averages over the recent generations, for the readiness endpoint"""
+    recent = list(recent_generation_metrics)
+
+    def mean(key):
+        values = [metrics[key] for metrics in recent if metrics[key] is not None]
+        return round(sum(values) / len(values), 3) if values else None
+    return {
+        "generations": len(recent),
+        "mean_generated_tokens": mean("generated_tokens"),
+        "mean_time_to_first_token": mean("time_to_first_token"),
+        "mean_tokens_per_second": mean("tokens_per_second"),
+    }
@@ -0,0 +1,116 @@
+import struct
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+# Stored vectors are either raw float32 bytes (format 0, what the stores always held)
+# or a header followed by the payload:
+#   magic (4 bytes) | format version (1) | dtype code (1) | reserved (2) | [int8: float32 scale] | values
+# Read as the first float32 of a raw vector the magic is a NaN (exponent bits all set,
+# non-zero mantissa), which no embedding model produces, so raw and versioned blobs
+# cannot be confused.
+MAGIC = b"VQ\xc1\xff"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sBB2x")
+SCALE = struct.Struct("<f")
+DTYPE_CODES = {"float32": 0, "float16": 1, "int8": 2}
+DTYPE_NAMES = {code: name for name, code in DTYPE_CODES.items()}
+NUMPY_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+
+def encode_vector(vector, dtype: str = "float32") -> bytes:
+    """Serialize one embedding; float32 stays raw so older readers keep working"""
+    vector = np.asarray(vector, dtype=np.float32)
+    if dtype == "float32":
+        return vector.tobytes()
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, DTYPE_CODES[dtype])
+    if dtype == "float16":
+        return header + vector.astype(np.float16).tobytes()
+    if dtype == "int8":
+        # Symmetric per-vector scale: the largest component maps to +-127
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        values = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        return header + SCALE.pack(scale) + values.tobytes()
+    raise ValueError(f"Unknown vector dtype: {dtype}")
+
+
+def decode_vector(blob: bytes) -> Tuple[str, np.ndarray, float]:
+    """(dtype, stored values, scale) of one serialized embedding"""
+    if len(blob) < HEADER.size or blob[:4] != MAGIC:
+        return "float32", np.frombuffer(blob, dtype=np.float32), 1.0
+    _, version, code = HEADER.unpack_from(blob)
+    if version > FORMAT_VERSION or code not in DTYPE_NAMES:
+        raise ValueError(f"Unsupported vector format {version}/{code}")
+    dtype = DTYPE_NAMES[code]
+    offset, scale = HEADER.size, 1.0
+    if dtype == "int8":
+        scale = SCALE.unpack_from(blob, offset)[0]
+        offset += SCALE.size
+    return dtype, np.frombuffer(blob, dtype=NUMPY_DTYPES[dtype], offset=offset), scale
+
+
+class QuantizedMatrix:
+    """Rows stored as float16 or int8 with per-row scales, scored without a float32 copy.
+
+    Indexing returns dequantized float32 rows, so code written for a float32 matrix
+    (the IVF index) works unchanged on the selected rows.
+    """
+
+    def __init__(self, values: np.ndarray, scales: Optional[np.ndarray] = None, chunk_size: int = 16384):
+        self.values = np.ascontiguousarray(values)
+        self.scales = None if scales is None else np.ascontiguousarray(scales, dtype=np.float32)
+        self.chunk_size = chunk_size
+
+    @property
+    def dtype(self) -> str:
+        return self.values.dtype.name
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.values.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, rows) -> np.ndarray:
+        values = self.values[rows].astype(np.float32)
+        if self.scales is not None:
+            scales = self.scales[rows]
+            values *= scales[..., None] if np.ndim(scales) else scales
+        return values
+
+    def __matmul__(self, other) -> np.ndarray:
+        """Scores against a query vector (or a matrix of them, one per column),
+        dequantizing a cache-sized block of rows at a time"""
+        other = np.asarray(other, dtype=np.float32)
+        scores = np.empty((len(self.values),) + other.shape[1:], dtype=np.float32)
+        for start in range(0, len(self.values), self.chunk_size):
+            end = start + self.chunk_size
+            scores[start:end] = self.values[start:end].astype(np.float32) @ other
+        if self.scales is not None:
+            # int8: the per-row scale factors out of the dot product
+            scores *= self.scales.reshape((-1,) + (1,) * (other.ndim - 1))
+        return scores
+
+    def tobytes(self) -> bytes:
+        return self.values.tobytes() + (b"" if self.scales is None else self.scales.tobytes())
+
+
+def decode_matrix(blobs: Sequence[bytes]):
+    """Stack serialized embeddings: a float32 ndarray, or a QuantizedMatrix if any row is quantized"""
+    decoded = [decode_vector(blob) for blob in blobs]
+    dtypes = {dtype for dtype, _, _ in decoded}
+    if dtypes <= {"float32"}:
+        return np.ascontiguousarray(np.vstack([values for _, values, _ in decoded]), dtype=np.float32)
+    if dtypes == {"float16"}:
+        return QuantizedMatrix(np.vstack([values for _, values, _ in decoded]))
+    if dtypes == {"int8"}:
+        return QuantizedMatrix(np.vstack([values for _, values, _ in decoded]),
+                               np.array([scale for _, _, scale in decoded], dtype=np.float32))
+    # Half-migrated table: float16 holds any of the formats with little loss
+    values = np.vstack([stored.astype(np.float32) * scale for _, stored, scale in decoded])
+    return QuantizedMatrix(values.astype(np.float16))
@@ -0,0 +1,176 @@
+import hashlib
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from ann_index import IVFIndex, matrix_fingerprint
+from sqlite_pool import DatabaseSnapshot, get_manager
+from vector_codec import decode_matrix
+
+
+class IndexData:
+    """One consistent snapshot of a loaded table; reloads swap in a new snapshot"""
+
+    def __init__(self, ids: np.ndarray, matrix: np.ndarray, metadata: Dict[str, list],
+                 row_digests: Dict[int, str], ann: Optional[IVFIndex] = None):
+        self.ids = ids
+        self.matrix = matrix
+        self.metadata = metadata
+        self.row_digests = row_digests
+        self.ann = ann
+
+
+class VectorIndex:
+    """In-memory similarity index over an embedding column of a SQLite table"""
+
+    def __init__(self, db_path: str, vector_column: str, columns: Sequence[str],
+                 table: str = "vector_store", required_columns: Sequence[str] = (),
+                 threshold: float = 0.7, ann_min_rows: Optional[int] = None,
+                 nlist: Optional[int] = None, nprobe: int = 32, refresh_interval: float = 5.0):
+        self.db_path = db_path
+        self.vector_column = vector_column
+        self.columns = list(columns)
+        self.table = table
+        self.required_columns = list(required_columns)
+        self.threshold = threshold
+        # Tables with at least ann_min_rows rows are searched with the approximate IVF index.
+        # It is off by default (None): best_match may miss the true best row, so enable it
+        # only after checking recall on the table with benchmark_ann.py. nprobe=32 kept
+        # recall@1 at ~0.995 on 50k rows, where nprobe=8 returned a wrong row 1 time in 20
+        self.ann_min_rows = ann_min_rows
+        self.nlist = nlist
+        self.nprobe = nprobe
+        # Read again when the database changed, checked at most every refresh_interval seconds
+        self._snapshot = DatabaseSnapshot(db_path, self._read, refresh_interval, on_reload=self._notify)
+        self._listeners: List[Callable[[List[int]], None]] = []
+
+    def load(self) -> "VectorIndex":
+        """Read all embeddings into a contiguous float32 matrix on first use, and
+        again when the database file has changed since"""
+        self._snapshot.get()
+        return self
+
+    def add_listener(self, callback: Callable[[List[int]], None]):
+        """Call callback(row_ids) with the added, changed or removed rows after a reload"""
+        self._listeners.append(callback)
+
+    def row_digest(self, row_id: int) -> str:
+        """Content hash of a row, changes whenever any of its columns change"""
+        return self._snapshot.get().row_digests.get(row_id, "")
+
+    def reload(self) -> "VectorIndex":
+        """Drop the resident data and read the table again"""
+        self._snapshot.reload()
+        return self
+
+    def _read(self) -> IndexData:
+        selected = ", ".join(["id"] + self.columns + [self.vector_column])
+        conditions = " AND ".join(f"{column} IS NOT NULL"
+                                  for column in [self.vector_column] + self.required_columns)
+        sql = f"SELECT {selected} FROM {self.table} WHERE {conditions} ORDER BY id"
+
+        rows = get_manager(self.db_path).execute(sql).fetchall()
+
+        if rows:
+            # float32 ndarray, or a QuantizedMatrix for float16/int8 stores
+            matrix = decode_matrix([row[-1] for row in rows])
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        metadata = {column: [row[i + 1] for row in rows] for i, column in enumerate(self.columns)}
+        row_digests = {row[0]: hashlib.sha1(repr(row).encode("utf-8")).hexdigest() for row in rows}
+        data = IndexData(ids, matrix, metadata, row_digests, self._load_ann(ids, matrix))
+        print(f"Loaded {len(rows)} embeddings from {self.db_path}")
+        return data
+
+    def _notify(self, previous: IndexData, data: IndexData):
+        changed = [row_id for row_id in set(data.row_digests) | set(previous.row_digests)
+                   if data.row_digests.get(row_id) != previous.row_digests.get(row_id)]
+        if changed:
+            for callback in self._listeners:
+                callback(sorted(changed))
+
+    @property
+    def ann_path(self) -> str:
+        return f"{self.db_path}.{self.table}.{self.vector_column}.ivf.npz"
+
+    def _load_ann(self, ids: np.ndarray, matrix: np.ndarray) -> Optional[IVFIndex]:
+        if self.ann_min_rows is None or len(ids) < self.ann_min_rows:
+            return None
+
+        fingerprint = matrix_fingerprint(ids, matrix)
+        try:
+            ann = IVFIndex.load(self.ann_path, fingerprint, nprobe=self.nprobe)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable ANN index {self.ann_path}: {e}")
+            ann = None
+        if ann is not None:
+            return ann
+
+        ann = IVFIndex.build(matrix, nlist=self.nlist, nprobe=self.nprobe,
+                             fingerprint=fingerprint)
+        try:
+            ann.save(self.ann_path)
+        except OSError as e:
+            print(f"Could not persist ANN index to {self.ann_path}: {e}")
+        print(f"Built IVF index with {ann.nlist} lists for {self.db_path}")
+        return ann
+
+    def __len__(self) -> int:
+        return len(self._snapshot.get().ids)
+
+    def scores(self, query_vector) -> np.ndarray:
+        """Similarity of the query against every row"""
+        return self._scores(self._snapshot.get(), query_vector)
+
+    @staticmethod
+    def _scores(data: IndexData, query_vector) -> np.ndarray:
+        if not len(data.ids):
+            return np.empty(0, dtype=np.float32)
+        return data.matrix @ np.asarray(query_vector, dtype=np.float32)
+
+    def search(self, query_vector, k: int, exact: bool = False):
+        """Return (row positions, scores) of the k best rows, best first"""
+        return self._search(self._snapshot.get(), query_vector, k, exact)
+
+    def _search(self, data: IndexData, query_vector, k: int, exact: bool = False):
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        if data.ann is not None and not exact:
+            return data.ann.search(data.matrix, query_vector, k)
+
+        scores = self._scores(data, query_vector)
+        if k < len(scores):
+            candidates = np.argpartition(scores, -k)[-k:]
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return candidates, scores[candidates]
+
+    def top_k(self, query_vector, k: int = 1, threshold: Optional[float] = None,
+              columns: Optional[Sequence[str]] = None) -> List[Dict]:
+        """Return the k most similar rows above the threshold, best first"""
+        data = self._snapshot.get()
+        if k <= 0 or not len(data.ids):
+            return []
+        candidates, scores = self._search(data, query_vector, k)
+
+        threshold = self.threshold if threshold is None else threshold
+        columns = self.columns if columns is None else list(columns)
+
+        results = []
+        for row, score in zip(candidates, scores):
+            similarity = float(score)
+            if threshold is not None and similarity <= threshold:
+                break
+            result = {column: data.metadata[column][row] for column in columns}
+            result["id"] = int(data.ids[row])
+            result["similarity"] = similarity
+            results.append(result)
+        return results
+
+    def best_match(self, query_vector, threshold: Optional[float] = None,
+                   columns: Optional[Sequence[str]] = None) -> Optional[Dict]:
+        """Return the single most similar row above the threshold, or None"""
+        results = self.top_k(query_vector, k=1, threshold=threshold, columns=columns)
+        return results[0] if results else None
@@ -2,6 +2,8 @@ import os
 import openai
 import json
 import time
+import asyncio
+import aiohttp
 from dotenv import load_dotenv
 import random
 
@@ -16,6 +18,9 @@ if not api_key:
 # Set API key from environment variable
 openai.api_key = api_key
 
+# Point OPENAI_BASE_URL at a local stub server (stub_openai_server.py) to test without paid calls
+API_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1').rstrip('/')
+
 def gpt4o_generate_dialog(prompt, model="gpt-4o", max_tokens=2000, temperature=0.7):
     """Generate a chemistry dialog using GPT-4o"""
     try:
@@ -32,6 +37,111 @@ def gpt4o_generate_dialog(prompt, model="gpt-4o", max_tokens=2000, temperature=0
         print(f"Error occurred: {e}")
         return None
 
+class TokenBucket:
+    """Request rate limiter that halves its rate on 429s and slowly recovers on success"""
+    def __init__(self, rate, capacity=None, min_rate=0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.throttled = 0.0
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def throttle(self):
+        # One burst of 429s from requests already in flight counts as a single signal
+        now = time.monotonic()
+        if now - self.throttled < 1.0:
+            return
+        self.throttled = now
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+    
+    def recover(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+def message_content(data):
+    """The reply text of a chat completion, or None when the body lacks it"""
+    try:
+        content = data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    return content.strip() if isinstance(content, str) else None
+
+async def async_generate_dialog(session, bucket, prompt, model="gpt-4o", max_tokens=2000, temperature=0.7,
+                                max_retries=6, base_delay=1.0, max_delay=60.0):
+    """Generate a chemistry dialog, retrying rate limits, server errors and timeouts"""
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }
+    for attempt in range(max_retries + 1):
+        # Exponential backoff with jitter, so throttled workers do not retry in lockstep
+        delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+        await bucket.acquire()
+        try:
+            async with session.post(f"{API_BASE_URL}/chat/completions", json=payload) as response:
+                if response.status == 200:
+                    content = message_content(await response.json())
+                    if content is not None:
+                        bucket.recover()
+                        return content
+                    print(f"Malformed response without message content, retrying in {delay:.1f} s")
+                else:
+                    if response.status == 429:
+                        bucket.throttle()
+                        retry_after = response.headers.get("Retry-After")
+                        if retry_after:
+                            try:
+                                delay = max(delay, float(retry_after))
+                            except ValueError:
+                                pass
+                    elif response.status < 500:
+                        print(f"Error occurred: HTTP {response.status}: {await response.text()}")
+                        return None
+                    print(f"HTTP {response.status}, retrying in {delay:.1f} s")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            # ValueError: a 200 response whose body is not JSON
+            print(f"Error occurred: {e!r}, retrying in {delay:.1f} s")
+        if attempt < max_retries:
+            await asyncio.sleep(delay)
+    return None
+
+async def generate_dialogs_async(combinations, on_result=None, concurrency=16, requests_per_second=5.0,
+                                 timeout=120):
+    """Generate one dialog per combination with at most concurrency requests in flight
+    
+    on_result(index, combo, dialog) is called as each dialog finishes (dialog is None on failure).
+    """
+    bucket = TokenBucket(requests_per_second)
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"Authorization": f"Bearer {api_key}"}
+    
+    async with aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def worker(index, combo):
+            async with semaphore:
+                prompt = create_chemistry_prompt(combo['topic'], combo['concept'], combo['level'])
+                dialog = await async_generate_dialog(session, bucket, prompt)
+            if on_result is not None:
+                on_result(index, combo, dialog)
+            return dialog
+        
+        return await asyncio.gather(*(worker(i, combo) for i, combo in enumerate(combinations)))
+
 def create_chemistry_prompt(topic, concept, level):
     """Create a prompt for generating a chemistry dialog"""
     return f"""
@@ -66,8 +176,29 @@ Instructor: [next guiding question]
 Make sure the dialog represents authentic chemistry education and Socratic teaching methods.
 """
 
-def generate_diverse_datasets(output_directory, num_dialogs=300):
-    """Generate diverse chemistry dialog datasets"""
+def combo_key(combo):
+    return f"{combo['topic']}|{combo['concept']}|{combo['level']}"
+
+def load_manifest(manifest_path):
+    """Keys of the combinations whose dialogs are already saved"""
+    completed = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    completed.add(json.loads(line)["key"])
+                except (ValueError, KeyError):
+                    pass  # a line cut short by a crash
+    return completed
+
+def generate_diverse_datasets(output_directory, num_dialogs=300, concurrency=16, requests_per_second=5.0,
+                              seed=42):
+    """Generate diverse chemistry dialog datasets
+    
+    Dialogs are appended to chemistry_educational_dialogs.jsonl as they arrive and their
+    (topic, concept, level) keys to generation_manifest.jsonl, so a rerun with the same
+    seed resumes where the last run stopped instead of paying for the same dialogs again.
+    """
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
     
@@ -144,48 +275,74 @@ def generate_diverse_datasets(output_directory, num_dialogs=300):
                     "level": level
                 })
     
-    # Shuffle to ensure diversity if we don't generate all combinations
-    random.shuffle(combinations)
+    # Shuffle to ensure diversity if we don't generate all combinations;
+    # seeded, so every run selects and numbers the same combinations
+    random.Random(seed).shuffle(combinations)
     
     # Select the required number of combinations
     selected_combinations = combinations[:num_dialogs]
-    
-    # Generate dialogs for each selected combination
-    all_dialogs = []
     for i, combo in enumerate(selected_combinations):
-        print(f"Generating dialog {i+1}/{num_dialogs}: {combo['topic']} - {combo['concept']} ({combo['level']})")
-        
-        prompt = create_chemistry_prompt(combo['topic'], combo['concept'], combo['level'])
-        dialog = gpt4o_generate_dialog(prompt)
+        combo["id"] = i+1
+    
+    jsonl_path = os.path.join(output_directory, "chemistry_educational_dialogs.jsonl")
+    manifest_path = os.path.join(output_directory, "generation_manifest.jsonl")
+    completed = load_manifest(manifest_path)
+    pending = [combo for combo in selected_combinations if combo_key(combo) not in completed]
+    print(f"{len(selected_combinations) - len(pending)} dialogs already generated, {len(pending)} to go")
+    
+    # Generate dialogs concurrently, saving each one as soon as it arrives
+    generated = 0
+    with open(jsonl_path, 'a', encoding='utf-8') as dataset, open(manifest_path, 'a', encoding='utf-8') as manifest:
+        def save_dialog(_, combo, dialog):
+            nonlocal generated
+            i = combo["id"] - 1
+            if dialog:
+                dialog_data = {
+                    "id": i+1,
+                    "topic": combo['topic'],
+                    "concept": combo['concept'],
+                    "level": combo['level'],
+                    "dialog": dialog
+                }
+                
+                # Save individual dialog file
+                filename = f"dialog_{i+1:03d}_{combo['topic'].replace(' ', '_')}_{combo['level']}.txt"
+                file_path = os.path.join(output_directory, filename)
+                
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    f.write(dialog)
+                
+                # The dialog is on disk before its key is, so a crash can only cause a redo, never a loss
+                dataset.write(json.dumps(dialog_data, ensure_ascii=False) + "\n")
+                dataset.flush()
+                manifest.write(json.dumps({"key": combo_key(combo), "id": i+1}) + "\n")
+                manifest.flush()
+                generated += 1
+                
+                print(f"Saved dialog {i+1}/{len(selected_combinations)} to {file_path}")
+            else:
+                print(f"Failed to generate dialog for {combo['topic']} - {combo['concept']}")
         
-        if dialog:
-            dialog_data = {
-                "id": i+1,
-                "topic": combo['topic'],
-                "concept": combo['concept'],
-                "level": combo['level'],
-                "dialog": dialog
-            }
-            all_dialogs.append(dialog_data)
-            
-            # Save individual dialog file
-            filename = f"dialog_{i+1:03d}_{combo['topic'].replace(' ', '_')}_{combo['level']}.txt"
-            file_path = os.path.join(output_directory, filename)
-            
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(dialog)
-            
-            print(f"Saved dialog to {file_path}")
-            
-            # To avoid API rate limits
-            time.sleep(1)
-        else:
-            print(f"Failed to generate dialog for {combo['topic']} - {combo['concept']}")
-    
-    # Save complete dataset as JSON
+        start = time.perf_counter()
+        asyncio.run(generate_dialogs_async(pending, on_result=save_dialog,
+                                           concurrency=concurrency, requests_per_second=requests_per_second))
+    print(f"Generated {generated}/{len(pending)} dialogs in {time.perf_counter() - start:.1f} s")
+    
+    # Save complete dataset as JSON, streamed from the JSONL so memory use stays flat
     json_path = os.path.join(output_directory, "chemistry_educational_dialogs.json")
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(all_dialogs, f, ensure_ascii=False, indent=2)
+    seen = set()
+    with open(jsonl_path, encoding='utf-8') as source, open(json_path, 'w', encoding='utf-8') as f:
+        f.write("[")
+        for line in source:
+            try:
+                dialog_data = json.loads(line)
+            except ValueError:
+                continue
+            if dialog_data["id"] in seen:
+                continue
+            f.write(("\n" if not seen else ",\n") + json.dumps(dialog_data, ensure_ascii=False, indent=2))
+            seen.add(dialog_data["id"])
+        f.write("\n]\n")
     
     print(f"Complete dataset saved to {json_path}")
 
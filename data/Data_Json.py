@@ -1,12 +1,71 @@
 import os
 import re
 import json
+import argparse
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-def parse_conversation_to_instructional_format(file_content):
-    """Convert dialogue format to instructional format"""
+# Bump when the conversion output changes, so incremental runs convert every file again
+FORMAT_VERSION = 1
+
+# First turn: anywhere in the text; later turns: after a blank line
+TURN_START = re.compile(r'(Student|Instructor): ')
+TURN_BOUNDARY = re.compile(r'\n\n(?=(?:Student|Instructor):)')
+
+FIRST_INSTRUCTION = "As a chemistry education assistant, when students express confusion about chemical concepts, use the Socratic method to guide their thinking rather than providing direct answers. Ask questions that help students explore on their own."
+FINAL_INSTRUCTION = "As a chemistry education assistant, the student has shown understanding of the concept. Help them summarize key points and confirm their understanding."
+MIDDLE_INSTRUCTION = "As a chemistry education assistant, based on the student's answer and previous dialogue history, continue using Socratic questioning to guide the student to think more deeply about this chemistry concept."
+
+def split_turns(file_content):
+    """Dialogue turns as (role, text) pairs, found in a single scan of the text"""
+    first = TURN_START.search(file_content)
+    if not first:
+        return []
+    
+    turns = []
+    position = first.start()
+    for boundary in TURN_BOUNDARY.finditer(file_content, position):
+        turns.append(file_content[position:boundary.start()])
+        position = boundary.end()
+    turns.append(file_content[position:])
+    
+    # Each chunk starts with "Role:"; the text is everything after the colon
+    return [(chunk[:chunk.index(':')], chunk[chunk.index(':') + 1:].strip()) for chunk in turns]
+
+class HistoryBuilder:
+    """Running "Previous ..." history, extended one turn at a time
     
-    # Use regex to extract dialogue turns
-    turns = re.findall(r'(Student|Instructor): (.*?)(?=\n\n(?:Student|Instructor):|$)', file_content, re.DOTALL)
+    With max_tokens set, only the most recent turns that fit in max_tokens are kept,
+    so the input of late turns in long dialogues stops growing.
+    """
+    def __init__(self, max_tokens=None, count_tokens=None):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens or (lambda text: len(text.split()))
+        self.lines = deque()
+        self.tokens = 0
+    
+    def add(self, role, text):
+        line = f"Previous {role.lower()}: {text}\n"
+        count = self.count_tokens(line) if self.max_tokens is not None else 0
+        self.lines.append((line, count))
+        self.tokens += count
+        if self.max_tokens is not None:
+            while self.lines and self.tokens > self.max_tokens:
+                self.tokens -= self.lines.popleft()[1]
+    
+    def text(self):
+        return "".join(line for line, _ in self.lines)
+
+def parse_conversation_to_instructional_format(file_content, max_history_tokens=None, count_tokens=None):
+    """Convert dialogue format to instructional format
+    
+    max_history_tokens: keep only the most recent turns of the history that fit,
+    counted with count_tokens (default: whitespace-separated words)
+    """
+    
+    # Extract dialogue turns
+    turns = split_turns(file_content)
     
     # If no dialogue format is found, return empty list
     if not turns:
@@ -14,32 +73,30 @@ def parse_conversation_to_instructional_format(file_content):
     
     # Create training data instances
     training_data = []
+    history = HistoryBuilder(max_history_tokens, count_tokens)
     
     # For each instructor response after a student question, create a training instance
     for i in range(0, len(turns)-1, 2):
-        if turns[i][0] == "Student" and i+1 < len(turns) and turns[i+1][0] == "Instructor":
-            student_text = turns[i][1].strip()
-            instructor_text = turns[i+1][1].strip()
-            
-            # Collect previous dialogue history
-            history = ""
-            if i > 0:
-                for j in range(0, i):
-                    role = turns[j][0]
-                    text = turns[j][1].strip()
-                    history += f"Previous {role.lower()}: {text}\n"
+        # Extend the dialogue history with the two turns before this one
+        for role, text in turns[max(i - 2, 0):i]:
+            history.add(role, text)
+        
+        if turns[i][0] == "Student" and turns[i+1][0] == "Instructor":
+            student_text = turns[i][1]
+            instructor_text = turns[i+1][1]
             
             # Create instruction based on dialogue stage
             if i == 0:
-                instruction = "As a chemistry education assistant, when students express confusion about chemical concepts, use the Socratic method to guide their thinking rather than providing direct answers. Ask questions that help students explore on their own."
+                instruction = FIRST_INSTRUCTION
             elif i >= len(turns) - 3:
-                instruction = "As a chemistry education assistant, the student has shown understanding of the concept. Help them summarize key points and confirm their understanding."
+                instruction = FINAL_INSTRUCTION
             else:
-                instruction = "As a chemistry education assistant, based on the student's answer and previous dialogue history, continue using Socratic questioning to guide the student to think more deeply about this chemistry concept."
+                instruction = MIDDLE_INSTRUCTION
             
             # If there's dialogue history, add it to the current input
-            if history:
-                current_input = history + "Current student: " + student_text
+            history_text = history.text()
+            if history_text:
+                current_input = history_text + "Current student: " + student_text
             else:
                 current_input = student_text
             
@@ -54,62 +111,151 @@ def parse_conversation_to_instructional_format(file_content):
     
     return training_data
 
-def batch_process_files(input_dir, output_dir):
-    """Batch process all txt files in the directory"""
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def convert_file(file_path, json_dir=None, max_history_tokens=None):
+    """Parse one dialogue file into JSONL lines; runs in a worker process
+    
+    Returns (filename, content sha1, JSONL lines, error message or None).
+    """
+    filename = os.path.basename(file_path)
+    try:
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        training_data = parse_conversation_to_instructional_format(raw.decode('utf-8'), max_history_tokens)
+        if training_data and json_dir:
+            # Create a JSON file for each input file
+            output_path = os.path.join(json_dir, os.path.splitext(filename)[0] + '.json')
+            with open(output_path, 'w', encoding='utf-8') as f:
+                json.dump(training_data, f, ensure_ascii=False, indent=2)
+        lines = [json.dumps(instance, ensure_ascii=False) + '\n' for instance in training_data]
+        return filename, hashlib.sha1(raw).hexdigest(), lines, None
+    except Exception as e:
+        return filename, None, [], str(e)
+
+def load_state(state_path, settings):
+    """Per-input bookkeeping of the previous run, or an empty state if it used another format"""
+    if os.path.exists(state_path):
+        with open(state_path, encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get("format_version") == FORMAT_VERSION and state.get("settings") == settings:
+            return state
+    return {"files": {}}
+
+def batch_process_files(input_dir, output_dir, workers=None, per_file_json=True, combined_json=True,
+                        incremental=True, max_history_tokens=None):
+    """Batch process all txt files in the directory
+    
+    Files are converted in a process pool and their instances streamed straight into
+    all_training_data.jsonl. With incremental=True, inputs whose size and mtime (or,
+    failing that, content hash) match the previous run are not parsed again: their
+    lines are copied over from the previous JSONL.
+    """
     
     # Ensure output directory exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
-    # Process all txt files
-    all_training_data = []
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.txt'):
-            file_path = os.path.join(input_dir, filename)
-            
-            try:
-                # Read file content
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    file_content = f.read()
-                
-                # Parse dialogue
-                training_data = parse_conversation_to_instructional_format(file_content)
-                
-                if training_data:
-                    # Create a JSON file for each input file
-                    output_filename = os.path.splitext(filename)[0] + '.json'
-                    output_path = os.path.join(output_dir, output_filename)
-                    
-                    with open(output_path, 'w', encoding='utf-8') as f:
-                        json.dump(training_data, f, ensure_ascii=False, indent=2)
-                    
-                    print(f"Processed {filename} and saved to {output_filename}")
-                    
-                    # Add data to the complete collection
-                    all_training_data.extend(training_data)
-                else:
+    jsonl_output_path = os.path.join(output_dir, 'all_training_data.jsonl')
+    state_path = os.path.join(output_dir, 'conversion_state.json')
+    settings = {"max_history_tokens": max_history_tokens}
+    state = load_state(state_path, settings) if incremental and os.path.exists(jsonl_output_path) else {"files": {}}
+    previous = state["files"]
+    files = {}
+    
+    # Split the inputs into unchanged ones (reused) and new or edited ones (converted)
+    reused, pending = [], []
+    for filename in sorted(os.listdir(input_dir)):
+        if not filename.endswith('.txt'):
+            continue
+        file_path = os.path.join(input_dir, filename)
+        status = os.stat(file_path)
+        old = previous.get(filename)
+        if old is not None and per_file_json and not os.path.exists(
+                os.path.join(output_dir, os.path.splitext(filename)[0] + '.json')) and old["count"]:
+            old = None  # per-file JSON requested but missing
+        if old is not None and (old["size"], old["mtime_ns"]) != (status.st_size, status.st_mtime_ns):
+            # Touched but possibly unchanged: the content hash decides
+            old = dict(old, size=status.st_size, mtime_ns=status.st_mtime_ns) \
+                if old["sha1"] == file_digest(file_path) else None
+        if old is not None:
+            reused.append((filename, old))
+        else:
+            pending.append((filename, status))
+    
+    total_instances = 0
+    failed = 0
+    tmp_path = jsonl_output_path + '.tmp'
+    # Binary mode, so offsets are byte positions that seek() can return to
+    with open(tmp_path, 'wb') as out:
+        # Unchanged inputs: byte ranges of the previous JSONL, copied without parsing
+        if reused:
+            with open(jsonl_output_path, 'rb') as old_jsonl:
+                for filename, old in sorted(reused, key=lambda item: item[1]["offset"]):
+                    old_jsonl.seek(old["offset"])
+                    offset = out.tell()
+                    out.write(old_jsonl.read(old["length"]))
+                    files[filename] = dict(old, offset=offset)
+                    total_instances += old["count"]
+        
+        # New and changed inputs: converted in parallel, written in input order as results arrive
+        json_dir = output_dir if per_file_json else None
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            paths = [os.path.join(input_dir, filename) for filename, _ in pending]
+            results = executor.map(convert_file, paths, [json_dir] * len(paths),
+                                   [max_history_tokens] * len(paths), chunksize=32)
+            for (filename, status), (_, digest, lines, error) in zip(pending, results):
+                if error is not None:
+                    failed += 1
+                    print(f"Error processing {filename}: {error}")
+                    continue
+                if not lines:
                     print(f"Could not extract dialogue from {filename}")
-            
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
+                offset = out.tell()
+                out.write("".join(lines).encode('utf-8'))
+                files[filename] = {"size": status.st_size, "mtime_ns": status.st_mtime_ns, "sha1": digest,
+                                   "offset": offset, "length": out.tell() - offset, "count": len(lines)}
+                total_instances += len(lines)
+    os.replace(tmp_path, jsonl_output_path)
     
-    # Save all training data to a single file
-    combined_output_path = os.path.join(output_dir, 'all_training_data.json')
-    with open(combined_output_path, 'w', encoding='utf-8') as f:
-        json.dump(all_training_data, f, ensure_ascii=False, indent=2)
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump({"format_version": FORMAT_VERSION, "settings": settings, "files": files}, f)
     
-    # Create JSONL version (one JSON object per line, suitable for most training frameworks)
-    jsonl_output_path = os.path.join(output_dir, 'all_training_data.jsonl')
-    with open(jsonl_output_path, 'w', encoding='utf-8') as f:
-        for instance in all_training_data:
-            f.write(json.dumps(instance, ensure_ascii=False) + '\n')
+    print(f"Converted {len(pending) - failed} files, reused {len(reused)} unchanged files, {failed} failed")
+    print(f"Processed a total of {total_instances} training instances")
     
-    print(f"Processed a total of {len(all_training_data)} training instances")
-    print(f"All data has been combined and saved to {combined_output_path} and {jsonl_output_path}")
+    # Save all training data to a single file, streamed from the JSONL
+    if combined_json:
+        combined_output_path = os.path.join(output_dir, 'all_training_data.json')
+        with open(jsonl_output_path, encoding='utf-8') as source, \
+                open(combined_output_path, 'w', encoding='utf-8') as f:
+            f.write("[")
+            for i, line in enumerate(source):
+                f.write(("\n" if i == 0 else ",\n") + json.dumps(json.loads(line), ensure_ascii=False, indent=2))
+            f.write("\n]")
+        print(f"All data has been combined and saved to {combined_output_path} and {jsonl_output_path}")
+    else:
+        print(f"All data has been saved to {jsonl_output_path}")
 
-# Set input and output directory paths
-input_directory = r"./chemistry_educational_dialogs"  # Replace with your TXT files directory
-output_directory = "./train_data/chemistry_educational_dialogs.json"  # Replace with your desired output directory for JSON files
+def parse_config():
+    parser = argparse.ArgumentParser(description='Convert dialogue TXT files to instruction-tuning JSON/JSONL')
+    # Replace with your TXT files directory and your desired output directory
+    parser.add_argument('--input_dir', type=str, default=r"./chemistry_educational_dialogs")
+    parser.add_argument('--output_dir', type=str, default="./train_data/chemistry_educational_dialogs.json")
+    parser.add_argument('--workers', type=int, default=None, help='conversion processes, defaults to the CPU count')
+    parser.add_argument('--no_per_file_json', action='store_true', help='skip the JSON file per input')
+    parser.add_argument('--no_combined_json', action='store_true', help='write only all_training_data.jsonl')
+    parser.add_argument('--force', action='store_true', help='convert every input, changed or not')
+    parser.add_argument('--max_history_tokens', type=int, default=None,
+                        help='keep only the most recent history turns within this many words')
+    return parser.parse_args()
 
-# Execute batch processing
-batch_process_files(input_directory, output_directory)
+if __name__ == "__main__":
+    args = parse_config()
+    
+    # Execute batch processing
+    batch_process_files(args.input_dir, args.output_dir, workers=args.workers,
+                        per_file_json=not args.no_per_file_json, combined_json=not args.no_combined_json,
+                        incremental=not args.force, max_history_tokens=args.max_history_tokens)
@@ -0,0 +1,68 @@
+import argparse
+import random
+import re
+import time
+
+from Data_Json import parse_conversation_to_instructional_format
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='Time dialogue-to-instruction conversion on long synthetic dialogues')
+    parser.add_argument('--turns', type=int, nargs='+', default=[10, 50, 200, 800])
+    parser.add_argument('--words_per_turn', type=int, default=40)
+    parser.add_argument('--max_history_tokens', type=int, default=1024)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def legacy_parse(file_content):
+    """The previous implementation: lookahead regex and a history rebuilt for every pair"""
+    turns = re.findall(r'(Student|Instructor): (.*?)(?=\n\n(?:Student|Instructor):|$)', file_content, re.DOTALL)
+    training_data = []
+    for i in range(0, len(turns)-1, 2):
+        if turns[i][0] == "Student" and i+1 < len(turns) and turns[i+1][0] == "Instructor":
+            history = ""
+            for j in range(0, i):
+                history += f"Previous {turns[j][0].lower()}: {turns[j][1].strip()}\n"
+            current_input = history + "Current student: " + turns[i][1].strip() if history else turns[i][1].strip()
+            training_data.append({"input": current_input, "output": turns[i+1][1].strip()})
+    return training_data
+
+
+def synthetic_dialog(turns, words_per_turn, rng):
+    vocabulary = ["entropy", "enthalpy", "equilibrium", "reaction", "energy", "why", "because", "the", "of", "rate"]
+    return "\n\n".join(
+        f"{'Student' if t % 2 == 0 else 'Instructor'}: " + " ".join(rng.choices(vocabulary, k=words_per_turn))
+        for t in range(turns))
+
+
+def timed(fn, text, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn(text)
+        best = min(best, time.perf_counter() - start)
+    return result, best * 1000
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    print(f"{'turns':>6} {'legacy ms':>10} {'new ms':>8} {'window ms':>10} {'output MB':>10} {'window MB':>10}")
+    for turns in args.turns:
+        text = synthetic_dialog(turns, args.words_per_turn, rng)
+        legacy, legacy_ms = timed(legacy_parse, text, args.repeats)
+        new, new_ms = timed(parse_conversation_to_instructional_format, text, args.repeats)
+        windowed, window_ms = timed(
+            lambda t: parse_conversation_to_instructional_format(t, max_history_tokens=args.max_history_tokens),
+            text, args.repeats)
+        assert [(d["input"], d["output"]) for d in new] == [(d["input"], d["output"]) for d in legacy]
+
+        size = sum(len(d["input"]) for d in new) / 1e6
+        window_size = sum(len(d["input"]) for d in windowed) / 1e6
+        print(f"{turns:>6} {legacy_ms:>10.2f} {new_ms:>8.2f} {window_ms:>10.2f} {size:>10.2f} {window_size:>10.2f}")
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    main(args)
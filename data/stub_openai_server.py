@@ -0,0 +1,66 @@
+import argparse
+import asyncio
+import random
+import time
+
+from aiohttp import web
+
+# Canned reply in the Instructor/Student format the real prompt asks for
+STUB_DIALOG = """Instructor: What do you already know about this concept?
+Student: I think it has something to do with energy, but I'm not sure how.
+Instructor: What would happen to the energy if the reaction ran in reverse?
+Student: It would change sign, so the reverse reaction would not be favourable.
+Instructor: How did you arrive at that conclusion?
+Student: Because the same quantity of energy is exchanged in the other direction."""
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='Stub chat completions server for testing dialog generation')
+    parser.add_argument('--port', type=int, default=8008)
+    parser.add_argument('--latency', type=float, default=2.0, help='seconds per completion')
+    parser.add_argument('--rate_limit', type=float, default=20.0, help='requests per second before 429s')
+    parser.add_argument('--error_rate', type=float, default=0.02, help='fraction of requests failing with 500')
+    return parser.parse_args()
+
+
+def create_app(latency=2.0, rate_limit=20.0, error_rate=0.02):
+    """POST /v1/chat/completions with OpenAI-shaped responses, 429s above rate_limit and random 500s"""
+    recent = []
+    stats = {"requests": 0, "rate_limited": 0, "errors": 0}
+
+    async def chat_completions(request):
+        payload = await request.json()
+        stats["requests"] += 1
+        now = time.monotonic()
+        recent[:] = [t for t in recent if now - t < 1.0]
+        if len(recent) >= rate_limit:
+            stats["rate_limited"] += 1
+            return web.json_response({"error": {"message": "Rate limit reached"}}, status=429,
+                                     headers={"Retry-After": "1"})
+        recent.append(now)
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return web.json_response({"error": {"message": "Internal error"}}, status=500)
+
+        await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        return web.json_response({
+            "id": f"chatcmpl-stub-{stats['requests']}",
+            "object": "chat.completion",
+            "model": payload.get("model", "stub"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": STUB_DIALOG}}],
+        })
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    print(f"Set OPENAI_BASE_URL=http://localhost:{args.port}/v1 to use this server")
+    web.run_app(create_app(args.latency, args.rate_limit, args.error_rate), port=args.port)
@@ -1 +1,251 @@
+import os
+import math
+import time
+import random
+import resource
+import argparse
+import torch
+import numpy as np
+import transformers
+from peft import LoraConfig, PeftModel, get_peft_model
+from pretokenize import IGNORE_INDEX, PackedDataset, collate_packed, read_jsonl, batched, tokenize_examples
 
+DEFAULT_PAD_TOKEN = "[PAD]"
+TRAINER_STATE = "trainer_state.pt"
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='LoRA fine-tuning on the Data_Json dialogue data')
+    parser.add_argument('--data_path', type=str, default="./train_data/chemistry_educational_dialogs.json/all_training_data.jsonl",
+                        help='JSONL from Data_Json.py, tokenized on the fly')
+    parser.add_argument('--packed_dir', type=str, default="", help='shards from pretokenize.py, used instead of --data_path')
+    parser.add_argument('--base_model', type=str, default="/data1/pretrained-models/llama-7b-hf")
+    parser.add_argument('--cache_dir', type=str, default="./cache")
+    parser.add_argument('--output_dir', type=str, default="./models/my_chedu_model")
+    parser.add_argument('--tiny', action='store_true', help='random 2-layer Llama with the base model tokenizer, for CPU tests')
+    parser.add_argument('--context_size', type=int, default=4096, help='context size during fine-tuning')
+    parser.add_argument('--lora_r', type=int, default=8)
+    parser.add_argument('--lora_alpha', type=int, default=16)
+    parser.add_argument('--lora_dropout', type=float, default=0.05)
+    parser.add_argument('--lora_target', type=str, default="q_proj,k_proj,v_proj,o_proj")
+    parser.add_argument('--trainable_params', type=str, default="embed_tokens,norm",
+                        help='modules trained in full and saved with the adapter')
+    parser.add_argument('--batch_size', type=int, default=1, help='sequences per micro-batch')
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=8)
+    parser.add_argument('--learning_rate', type=float, default=2e-5)
+    parser.add_argument('--weight_decay', type=float, default=0.0)
+    parser.add_argument('--warmup_steps', type=int, default=20)
+    parser.add_argument('--max_steps', type=int, default=1000, help='optimizer steps')
+    parser.add_argument('--max_grad_norm', type=float, default=1.0)
+    parser.add_argument('--gradient_checkpointing', action='store_true')
+    parser.add_argument('--log_steps', type=int, default=1)
+    parser.add_argument('--save_steps', type=int, default=100)
+    parser.add_argument('--save_total_limit', type=int, default=3)
+    parser.add_argument('--resume', type=str, default="", help='checkpoint directory, or "latest" in --output_dir')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    return args
+
+
+class ExampleDataset(torch.utils.data.Dataset):
+    """One sequence per JSONL record, tokenized once at startup"""
+    def __init__(self, data_path, tokenizer, context_size):
+        self.examples = []
+        for examples in batched(read_jsonl(data_path), 1000):
+            for ids, mask in tokenize_examples(examples, tokenizer, context_size):
+                input_ids = torch.tensor(ids)
+                labels = input_ids.masked_fill(torch.tensor(mask) == 0, IGNORE_INDEX)
+                self.examples.append({"input_ids": input_ids, "labels": labels,
+                                      "position_ids": torch.arange(len(ids))})
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, i):
+        return self.examples[i]
+
+
+def load_model_and_tokenizer(args):
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        args.base_model,
+        cache_dir=args.cache_dir,
+        model_max_length=args.context_size,
+        padding_side="right",
+        use_fast=True,
+    )
+    dtype = torch.bfloat16 if torch.cuda.is_available() else torch.float32
+
+    if args.tiny:
+        config = transformers.LlamaConfig(
+            vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+            num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=args.context_size,
+            bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+        )
+        model = transformers.LlamaForCausalLM(config).to(dtype)
+    else:
+        # Set RoPE scaling factor, as Inference.py does for the same --context_size
+        config = transformers.AutoConfig.from_pretrained(args.base_model, cache_dir=args.cache_dir)
+        orig_ctx_len = getattr(config, "max_position_embeddings", None)
+        if orig_ctx_len and args.context_size > orig_ctx_len:
+            scaling_factor = float(math.ceil(args.context_size / orig_ctx_len))
+            config.rope_scaling = {"type": "linear", "factor": scaling_factor}
+        model = transformers.AutoModelForCausalLM.from_pretrained(
+            args.base_model,
+            config=config,
+            cache_dir=args.cache_dir,
+            torch_dtype=dtype,
+        )
+
+    # Llama has no pad token; Inference.py expects the embeddings resized for the added one
+    if tokenizer.pad_token is None:
+        tokenizer.add_special_tokens({"pad_token": DEFAULT_PAD_TOKEN})
+        model.resize_token_embeddings(len(tokenizer))
+    return model, tokenizer
+
+
+def checkpoints(output_dir):
+    if not os.path.isdir(output_dir):
+        return []
+    steps = [int(name.split("-")[1]) for name in os.listdir(output_dir)
+             if name.startswith("checkpoint-") and os.path.isfile(os.path.join(output_dir, name, TRAINER_STATE))]
+    return [os.path.join(output_dir, f"checkpoint-{step}") for step in sorted(steps)]
+
+
+def save_checkpoint(model, optimizer, scheduler, state, args):
+    path = os.path.join(args.output_dir, f"checkpoint-{state['step']}")
+    model.save_pretrained(path)
+    torch.save({
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "state": state,
+        "rng": {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None},
+    }, os.path.join(path, TRAINER_STATE))
+    for old in checkpoints(args.output_dir)[:-args.save_total_limit]:
+        for root, dirs, files in os.walk(old, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(old)
+    return path
+
+
+def batches(dataset, batch_size, seed, epoch, offset, pad_token_id, dtype):
+    """Micro-batches in a per-epoch seeded order, starting offset micro-batches into the epoch"""
+    while True:
+        generator = torch.Generator().manual_seed(seed + epoch)
+        order = torch.randperm(len(dataset), generator=generator).tolist()
+        for start in range(offset * batch_size, len(order), batch_size):
+            yield epoch, collate_packed([dataset[i] for i in order[start:start + batch_size]], pad_token_id, dtype)
+        epoch, offset = epoch + 1, 0
+
+
+def peak_memory_mb(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def train(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    model, tokenizer = load_model_and_tokenizer(args)
+    if args.gradient_checkpointing:
+        model.gradient_checkpointing_enable()
+        model.enable_input_require_grads()
+
+    resume = args.resume
+    if resume == "latest":
+        found = checkpoints(args.output_dir)
+        resume = found[-1] if found else ""
+    if resume:
+        model = PeftModel.from_pretrained(model, resume, is_trainable=True)
+    else:
+        lora_config = LoraConfig(
+            r=args.lora_r,
+            lora_alpha=args.lora_alpha,
+            target_modules=args.lora_target.split(","),
+            lora_dropout=args.lora_dropout,
+            bias="none",
+            modules_to_save=[name for name in args.trainable_params.split(",") if name] or None,
+            task_type="CAUSAL_LM",
+        )
+        model = get_peft_model(model, lora_config)
+    model.to(device)
+    model.print_trainable_parameters()
+
+    if args.packed_dir:
+        dataset = PackedDataset(args.packed_dir)
+    else:
+        dataset = ExampleDataset(args.data_path, tokenizer, args.context_size)
+    print(f"Training on {len(dataset)} sequences")
+
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad],
+                                  lr=args.learning_rate, weight_decay=args.weight_decay)
+    scheduler = transformers.get_constant_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps)
+    state = {"step": 0, "epoch": 0, "offset": 0}
+    if resume:
+        saved = torch.load(os.path.join(resume, TRAINER_STATE), map_location="cpu", weights_only=False)
+        optimizer.load_state_dict(saved["optimizer"])
+        scheduler.load_state_dict(saved["scheduler"])
+        state = saved["state"]
+        random.setstate(saved["rng"]["python"])
+        np.random.set_state(saved["rng"]["numpy"])
+        torch.set_rng_state(saved["rng"]["torch"])
+        if saved["rng"]["cuda"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(saved["rng"]["cuda"])
+        print(f"Resumed from {resume} at step {state['step']}")
+
+    data = batches(dataset, args.batch_size, args.seed, state["epoch"], state["offset"], tokenizer.pad_token_id,
+                   next(model.parameters()).dtype)
+    steps_per_epoch = math.ceil(len(dataset) / args.batch_size)
+    model.train()
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    while state["step"] < args.max_steps:
+        start = time.perf_counter()
+        step_loss, step_tokens = 0.0, 0
+        for _ in range(args.gradient_accumulation_steps):
+            epoch, batch = next(data)
+            if epoch != state["epoch"]:
+                state["epoch"], state["offset"] = epoch, 0
+            state["offset"] += 1
+            batch = {key: value.to(device) for key, value in batch.items()}
+            loss = model(**batch).loss / args.gradient_accumulation_steps
+            loss.backward()
+            step_loss += loss.item()
+            step_tokens += int((batch["input_ids"] != tokenizer.pad_token_id).sum())
+        if state["offset"] >= steps_per_epoch:
+            state["epoch"], state["offset"] = state["epoch"] + 1, 0
+
+        grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+        optimizer.step()
+        scheduler.step()
+        optimizer.zero_grad(set_to_none=True)
+        state["step"] += 1
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        step_time = time.perf_counter() - start
+
+        if state["step"] % args.log_steps == 0:
+            print(f"step {state['step']}/{args.max_steps} | epoch {state['epoch']} | loss {step_loss:.4f} | "
+                  f"grad norm {float(grad_norm):.3f} | lr {scheduler.get_last_lr()[0]:.2e} | "
+                  f"{step_tokens / step_time:.0f} tok/s | step {step_time * 1000:.0f} ms | "
+                  f"peak mem {peak_memory_mb(device):.0f} MB")
+        if state["step"] % args.save_steps == 0 or state["step"] == args.max_steps:
+            print(f"Saved checkpoint to {save_checkpoint(model, optimizer, scheduler, state, args)}")
+
+    # Adapter and tokenizer for PeftModel.from_pretrained in Inference.py
+    model.save_pretrained(args.output_dir)
+    tokenizer.save_pretrained(args.output_dir)
+    print(f"Model saved to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    train(args)
@@ -0,0 +1,244 @@
+import argparse
+import hashlib
+import json
+import os
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+import torch
+import transformers
+
+# Same Llama-2 chat template as PROMPT_DICT["prompt_input_llama2"] in code/Inference.py,
+# so the fine-tune sees exactly the prompts it is served with
+PROMPT_INPUT_LLAMA2 = (
+    "<s>[INST] <<SYS>>\n"
+    "As a chemistry education assistant, when students express confusion about chemical concepts, use the Socratic method to guide their thinking rather than providing direct answers. Ask questions that help students explore on their own.\n\n"
+    "As a chemistry education assistant, based on the student's answer and previous dialogue history, continue using Socratic questioning to guide the student to think more deeply about this chemistry concept.\n"
+    "<</SYS>> \n\n {instruction} [/INST]"
+)
+IGNORE_INDEX = -100
+INDEX_FILE = "index.json"
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='Tokenize and pack instruction data into memory-mapped shards')
+    parser.add_argument('--data_path', type=str, default="./train_data/chemistry_educational_dialogs.json/all_training_data.jsonl")
+    parser.add_argument('--output_dir', type=str, default="./train_data/packed")
+    parser.add_argument('--base_model', type=str, default="/data1/pretrained-models/llama-7b-hf")
+    parser.add_argument('--cache_dir', type=str, default="./cache")
+    parser.add_argument('--context_size', type=int, default=4096, help='length of a packed sequence')
+    parser.add_argument('--shard_tokens', type=int, default=100_000_000, help='tokens per shard file')
+    parser.add_argument('--batch_size', type=int, default=1000, help='examples tokenized per call')
+    return parser.parse_args()
+
+
+def format_example(example: Dict) -> Tuple[str, str]:
+    """(prompt, response) of one Data_Json record; the stage instruction precedes the dialogue"""
+    instruction = example["instruction"]
+    if example.get("input"):
+        instruction = f"{instruction}\n\n{example['input']}"
+    return PROMPT_INPUT_LLAMA2.format_map({"instruction": instruction}), f" {example['output']}"
+
+
+def read_jsonl(path: str) -> Iterator[Dict]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def batched(items: Iterator, size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def tokenize_examples(examples: List[Dict], tokenizer, context_size: int) -> Iterator[Tuple[List[int], List[int]]]:
+    """(token ids, loss mask) per example: only response tokens and the closing EOS are trained on"""
+    prompts, responses = zip(*(format_example(example) for example in examples))
+    # The template already starts with <s>, so the tokenizer must not add another BOS
+    prompt_ids = tokenizer(list(prompts), add_special_tokens=False)["input_ids"]
+    response_ids = tokenizer(list(responses), add_special_tokens=False)["input_ids"]
+    for prompt, response in zip(prompt_ids, response_ids):
+        response = response + [tokenizer.eos_token_id]
+        # Over-long examples keep their response and the two ends of the prompt (system prompt,
+        # latest turns); the middle, where the oldest dialogue history sits, is cut
+        keep = max(context_size - len(response), 2)
+        if len(prompt) > keep:
+            prompt = prompt[:keep // 2] + prompt[len(prompt) - (keep - keep // 2):]
+        ids = (prompt + response)[:context_size]
+        yield ids, ([0] * len(prompt) + [1] * len(response))[:context_size]
+
+
+class ShardWriter:
+    """Appends packed sequences to <name>.tokens / <name>.mask files plus offset arrays"""
+
+    def __init__(self, output_dir: str, dtype, shard_tokens: int):
+        self.output_dir = output_dir
+        self.dtype = dtype
+        self.shard_tokens = shard_tokens
+        self.shards = []
+        self._files = None
+
+    def _open(self):
+        name = f"shard_{len(self.shards):05d}"
+        self._files = (open(os.path.join(self.output_dir, f"{name}.tokens"), "wb"),
+                       open(os.path.join(self.output_dir, f"{name}.mask"), "wb"))
+        self._name, self._tokens, self._packs, self._segments = name, 0, [0], []
+
+    def write_pack(self, ids: List[int], mask: List[int], segments: List[int]):
+        if self._files is None:
+            self._open()
+        self._files[0].write(np.asarray(ids, dtype=self.dtype).tobytes())
+        self._files[1].write(np.asarray(mask, dtype=np.uint8).tobytes())
+        self._segments.extend(self._tokens + start for start in segments)
+        self._tokens += len(ids)
+        self._packs.append(self._tokens)
+        if self._tokens >= self.shard_tokens:
+            self.close()
+
+    def close(self):
+        if self._files is None:
+            return
+        for f in self._files:
+            f.close()
+        np.save(os.path.join(self.output_dir, f"{self._name}.packs.npy"), np.asarray(self._packs, dtype=np.int64))
+        np.save(os.path.join(self.output_dir, f"{self._name}.segments.npy"),
+                np.asarray(self._segments, dtype=np.int64))
+        self.shards.append({"name": self._name, "tokens": self._tokens, "packs": len(self._packs) - 1})
+        self._files = None
+
+
+def pretokenize(data_path: str, output_dir: str, tokenizer, context_size: int = 4096,
+                shard_tokens: int = 100_000_000, batch_size: int = 1000) -> Dict:
+    """Tokenize a Data_Json JSONL file and pack examples into sequences of at most context_size tokens
+
+    Examples are packed whole, in order, into the current sequence until the next one no
+    longer fits. Each example's start offset is stored, so loaders can restart position ids
+    at example boundaries and keep examples from attending to each other (collate_packed).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    dtype = np.uint16 if len(tokenizer) <= np.iinfo(np.uint16).max + 1 else np.uint32
+    writer = ShardWriter(output_dir, dtype, shard_tokens)
+    stats = {"examples": 0, "tokens": 0, "loss_tokens": 0}
+
+    pack_ids, pack_mask, pack_segments = [], [], []
+    for examples in batched(read_jsonl(data_path), batch_size):
+        for ids, mask in tokenize_examples(examples, tokenizer, context_size):
+            if pack_ids and len(pack_ids) + len(ids) > context_size:
+                writer.write_pack(pack_ids, pack_mask, pack_segments)
+                pack_ids, pack_mask, pack_segments = [], [], []
+            pack_segments.append(len(pack_ids))
+            pack_ids.extend(ids)
+            pack_mask.extend(mask)
+            stats["examples"] += 1
+            stats["tokens"] += len(ids)
+            stats["loss_tokens"] += sum(mask)
+    if pack_ids:
+        writer.write_pack(pack_ids, pack_mask, pack_segments)
+    writer.close()
+
+    stats["packs"] = sum(shard["packs"] for shard in writer.shards)
+    stats["fill"] = stats["tokens"] / (stats["packs"] * context_size) if stats["packs"] else 0.0
+    index = {
+        "dtype": np.dtype(dtype).name,
+        "context_size": context_size,
+        "tokenizer": getattr(tokenizer, "name_or_path", ""),
+        "vocab_size": len(tokenizer),
+        "template_sha1": hashlib.sha1(PROMPT_INPUT_LLAMA2.encode("utf-8")).hexdigest(),
+        "source": os.path.abspath(data_path),
+        "stats": stats,
+        "shards": writer.shards,
+    }
+    with open(os.path.join(output_dir, INDEX_FILE), "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    """Packed sequences read straight from the memory-mapped shards, nothing loaded up front"""
+
+    def __init__(self, data_dir: str):
+        with open(os.path.join(data_dir, INDEX_FILE), encoding="utf-8") as f:
+            self.index = json.load(f)
+        dtype = np.dtype(self.index["dtype"])
+        self.shards = []
+        for shard in self.index["shards"]:
+            path = os.path.join(data_dir, shard["name"])
+            self.shards.append((
+                np.memmap(f"{path}.tokens", dtype=dtype, mode="r"),
+                np.memmap(f"{path}.mask", dtype=np.uint8, mode="r"),
+                np.load(f"{path}.packs.npy"),
+                np.load(f"{path}.segments.npy"),
+            ))
+        # Global pack number -> (shard, local pack number)
+        self.cumulative = np.cumsum([0] + [shard["packs"] for shard in self.index["shards"]])
+
+    def __len__(self) -> int:
+        return int(self.cumulative[-1])
+
+    def __getitem__(self, i: int) -> Dict[str, torch.Tensor]:
+        shard_number = int(np.searchsorted(self.cumulative, i, side="right")) - 1
+        tokens, mask, packs, segments = self.shards[shard_number]
+        local = i - self.cumulative[shard_number]
+        start, end = int(packs[local]), int(packs[local + 1])
+
+        input_ids = torch.from_numpy(tokens[start:end].astype(np.int64))
+        labels = input_ids.masked_fill(torch.from_numpy(mask[start:end] == 0), IGNORE_INDEX)
+        # Position ids restart at every packed example
+        starts = segments[np.searchsorted(segments, start):np.searchsorted(segments, end)] - start
+        position_ids = torch.arange(end - start)
+        for example_start, next_start in zip(starts, list(starts[1:]) + [end - start]):
+            position_ids[example_start:next_start] -= int(example_start)
+        return {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+
+
+def packed_attention_mask(position_ids: torch.Tensor, dtype=torch.float32) -> torch.Tensor:
+    """Additive (batch, 1, length, length) causal mask that only lets tokens attend within their own example.
+
+    Examples start where position ids restart at 0; padding has position id 0 too, so every pad
+    token is an example of its own and no row of the mask is fully masked.
+    """
+    segments = torch.cumsum(position_ids == 0, dim=-1)
+    length = position_ids.shape[-1]
+    causal = torch.ones(length, length, dtype=torch.bool).tril()
+    allowed = (segments[:, :, None] == segments[:, None, :]) & causal
+    mask = torch.zeros(allowed.shape, dtype=dtype).masked_fill(~allowed, torch.finfo(dtype).min)
+    return mask[:, None]
+
+
+def collate_packed(batch: List[Dict[str, torch.Tensor]], pad_token_id: int = 0,
+                   dtype=torch.float32) -> Dict[str, torch.Tensor]:
+    """Right-pad packs of a batch to a common length, with a block-diagonal attention mask in the model's dtype"""
+    length = max(item["input_ids"].shape[0] for item in batch)
+
+    def pad(key, value):
+        return torch.stack([torch.nn.functional.pad(item[key], (0, length - item[key].shape[0]), value=value)
+                            for item in batch])
+    position_ids = pad("position_ids", 0)
+    return {
+        "input_ids": pad("input_ids", pad_token_id),
+        "labels": pad("labels", IGNORE_INDEX),
+        "position_ids": position_ids,
+        "attention_mask": packed_attention_mask(position_ids, dtype),
+    }
+
+
+def main(args):
+    tokenizer = transformers.AutoTokenizer.from_pretrained(args.base_model, cache_dir=args.cache_dir, use_fast=True)
+    index = pretokenize(args.data_path, args.output_dir, tokenizer, context_size=args.context_size,
+                        shard_tokens=args.shard_tokens, batch_size=args.batch_size)
+    stats = index["stats"]
+    print(f"Packed {stats['examples']} examples ({stats['tokens']} tokens, {stats['loss_tokens']} trained on) "
+          f"into {stats['packs']} sequences of up to {args.context_size} tokens, {stats['fill']:.1%} filled, "
+          f"{len(index['shards'])} shards in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    main(args)